@@ -0,0 +1,215 @@
+"""
+Admission control and load shedding.
+
+Requests are sorted into three classes by route:
+    CRITICAL: writes a guest is waiting on (reserving a table, placing an order)
+    NORMAL: everything not listed
+    BULK: full list reads and exports, the first thing to give up under load
+Routes mapped to None (health checks, /metrics, long-lived streams) are never held back.
+
+Each class may fill only a share of ADMISSION_CONCURRENCY in-flight requests, so bulk reads can never take the room
+the writes need. A request over its share waits its turn for a little while, higher classes first, and is turned away
+with 503 and Retry-After if no room frees up. Bulk reads don't wait at all. Requests are also shed before they start
+when checkouts from the primary pool have recently been waiting too long: bulk reads past ADMISSION_SHED_WAIT seconds,
+normal requests past four times that. Failing those early keeps the pool free for critical work, where letting them
+queue would turn a spike into timeouts for everyone.
+
+With RATE_LIMIT set, each client (X-Client-Id, or the remote address) also gets a token bucket of RATE_LIMIT requests
+per second with bursts up to RATE_BURST, and is answered 429 past it.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import OrderedDict
+
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+
+import pool
+
+CRITICAL, NORMAL, BULK = 0, 1, 2
+CLASS_NAMES = ("critical", "normal", "bulk")
+
+CONCURRENCY = int(os.getenv('ADMISSION_CONCURRENCY', 4 * pool.MAX_CONNECTIONS))
+# Share of CONCURRENCY each class may fill, the rest is kept for the classes above it
+SHARES = (1.0, 0.8, 0.5)
+# Seconds a request over its share waits for room
+QUEUE_WAIT = float(os.getenv('ADMISSION_QUEUE_WAIT', 2))
+WAITS = (QUEUE_WAIT, QUEUE_WAIT / 2, 0)
+SHED_WAIT = float(os.getenv('ADMISSION_SHED_WAIT', 0.5))
+# Average pool wait above which each class is shed. Critical requests are only ever queued
+SHED_WAITS = (None, 4 * SHED_WAIT, SHED_WAIT)
+RATE_LIMIT = float(os.getenv('RATE_LIMIT', 0))
+RATE_BURST = float(os.getenv('RATE_BURST', max(2 * RATE_LIMIT, 1)))
+RATE_CLIENTS = int(os.getenv('RATE_CLIENTS', 10000))
+
+
+class TokenBuckets:
+    """
+    A token bucket per client, refilled at rate tokens a second up to burst. Only the maxsize most recently seen
+    clients are kept; a client that was dropped starts again with a full bucket.
+    """
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, maxsize=RATE_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    def take(self, client, cost=1):
+        """
+        Returns 0 if the request may go ahead, otherwise the seconds until it would.
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / self.rate
+        self._buckets[client] = (tokens, now)
+        self._buckets.move_to_end(client)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class Admission:
+    """
+    Priority-aware limit on in-flight requests, with shedding on pool pressure.
+        pressure: db.Pressure of the primary pool
+        concurrency: in-flight requests across all classes
+    """
+    def __init__(self, pressure, concurrency=CONCURRENCY, shares=SHARES, waits=WAITS, shed_waits=SHED_WAITS):
+        self.pressure = pressure
+        self.limits = tuple(max(1, int(concurrency * share)) for share in shares)
+        self.waits = waits
+        self.shed_waits = shed_waits
+        self.in_flight = 0
+        self._waiters = []
+        self._counter = itertools.count()
+        self.admitted = [0, 0, 0]
+        self.shed = [0, 0, 0]
+        self.rate_limited = [0, 0, 0]
+
+    def overloaded(self, priority):
+        threshold = self.shed_waits[priority]
+        return threshold is not None and self.pressure.average_wait() > threshold
+
+    def _queued_ahead(self, priority):
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        return bool(self._waiters) and self._waiters[0][0] <= priority
+
+    async def acquire(self, priority):
+        """
+        Returns True once the request holds a slot, to be given back with release(), or False if it should be shed.
+        """
+        if self.overloaded(priority):
+            self.shed[priority] += 1
+            return False
+        if self.in_flight < self.limits[priority] and not self._queued_ahead(priority):
+            self.in_flight += 1
+            self.admitted[priority] += 1
+            return True
+        if self.waits[priority] <= 0:
+            self.shed[priority] += 1
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await asyncio.wait_for(future, self.waits[priority])
+        except asyncio.TimeoutError:
+            self.shed[priority] += 1
+            return False
+        except BaseException:
+            # Cancelled after release() had already handed over a slot, so give it back
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        self.admitted[priority] += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        # Wake waiters in class order, while the head of the line fits in its class's share
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.in_flight >= self.limits[priority]:
+                break
+            heapq.heappop(self._waiters)
+            self.in_flight += 1
+            future.set_result(None)
+
+    def retry_after(self):
+        return max(1, math.ceil(self.pressure.average_wait()))
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'queued': sum(1 for waiter in self._waiters if not waiter[2].done()),
+                'admitted': dict(zip(CLASS_NAMES, self.admitted)), 'shed': dict(zip(CLASS_NAMES, self.shed)),
+                'rate_limited': dict(zip(CLASS_NAMES, self.rate_limited))}
+
+
+def client_id(scope):
+    for name, value in scope.get("headers", ()):
+        if name == b"x-client-id":
+            return value.decode("latin-1")
+    client = scope.get("client")
+    return client[0] if client else None
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware putting every HTTP request through an Admission and, optionally, TokenBuckets.
+        routes: the app's routes, matched to find each request's class
+        priorities: {(method, route path): class or None}. Anything missing is NORMAL
+    """
+    def __init__(self, app, admission, routes, priorities, buckets=None):
+        self.app = app
+        self.admission = admission
+        self.routes = routes
+        self.priorities = priorities
+        self.buckets = buckets
+
+    def classify(self, scope):
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route, self.priorities.get((scope["method"], route.path), NORMAL)
+        return None, NORMAL
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        route, priority = self.classify(scope)
+        if priority is None:
+            return await self.app(scope, receive, send)
+
+        if self.buckets is not None:
+            wait = self.buckets.take(client_id(scope))
+            if wait:
+                self.admission.rate_limited[priority] += 1
+                return await self._reject(scope, receive, send, route, 429, "Too many requests", math.ceil(wait))
+
+        if not await self.admission.acquire(priority):
+            return await self._reject(scope, receive, send, route, 503, "Server is busy, try again shortly",
+                                      self.admission.retry_after())
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.release()
+
+    async def _reject(self, scope, receive, send, route, status_code, detail, retry_after):
+        # Lets MetricsMiddleware label the rejection with the route it was meant for
+        if route is not None:
+            scope["route"] = route
+        response = JSONResponse({'detail': detail}, status_code=status_code, headers={"Retry-After": str(retry_after)})
+        await response(scope, receive, send)
@@ -0,0 +1,57 @@
+"""
+Best-fit table allocation. Keeps the available tables sorted by capacity so the host stand can ask for "a table for
+4" and get the smallest one that fits.
+
+The index only narrows and orders the candidates. The database has the final word: ALLOCATE_TABLE locks the first
+candidate that is still free with FOR UPDATE SKIP LOCKED, so hosts racing for the same table get different ones.
+"""
+import bisect
+
+
+class AvailabilityIndex:
+    """
+    Available tables as a sorted list of (max_customer, table_id), plus every known table's capacity.
+    """
+    def __init__(self):
+        self._capacity = {}
+        self._available = []
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._available)
+
+    def load(self, rows):
+        """
+        Rebuilds the index from public.table rows (GET_TABLE_INFO).
+        """
+        self._capacity = {row.table_id: row.max_customer for row in rows}
+        self._available = sorted((row.max_customer, row.table_id) for row in rows if row.table_available)
+        self.loaded = True
+
+    def take(self, table_id):
+        capacity = self._capacity.get(table_id)
+        if capacity is None:
+            return
+        position = bisect.bisect_left(self._available, (capacity, table_id))
+        if position < len(self._available) and self._available[position] == (capacity, table_id):
+            del self._available[position]
+
+    def release(self, table_id):
+        capacity = self._capacity.get(table_id)
+        if capacity is None:
+            # A table we haven't seen yet, pick it up on the next load
+            self.loaded = False
+            return
+        position = bisect.bisect_left(self._available, (capacity, table_id))
+        if position == len(self._available) or self._available[position] != (capacity, table_id):
+            self._available.insert(position, (capacity, table_id))
+
+    def release_all(self):
+        self._available = sorted((capacity, table_id) for table_id, capacity in self._capacity.items())
+
+    def candidates(self, party_size):
+        """
+        Table ids that fit party_size, smallest first.
+        """
+        start = bisect.bisect_left(self._available, (party_size, ))
+        return [table_id for _, table_id in self._available[start:]]
@@ -0,0 +1,83 @@
+"""
+Order analytics for the manager dashboards, read from rollup tables instead of rescanning public.order_items.
+
+Three rollups:
+    public.table_rollup: orders, items and currently open orders per table. Each order counts as one cover, since
+    placing an order doesn't record guest_amount yet
+    public.food_rollup: quantity sold and orders per food_id
+    public.hourly_rollup: orders and items per hour, by the time the order was placed
+
+Placing orders adds them to every rollup in the same transaction as the insert, so the numbers never disagree with
+the orders that committed. Clearing an order only closes it on its table; what it sold stays counted. Food and
+hourly buckets are spread over ROLLUP_SHARDS rows each and summed on read, so a busy hour doesn't serialise every
+order on one row lock. A dashboard read touches a number of rows that depends on the menu, tables and time range,
+never on how many orders there are.
+
+migrate.py creates the rollups, and fills them once from the orders a database already has.
+"""
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+import queries as q
+from bookings import aware
+
+SHARDS = int(os.getenv('ROLLUP_SHARDS', 8))
+DEFAULT_HOURS = 24
+MAX_HOURS = 24 * 92
+DEFAULT_FOODS = 50
+
+log = logging.getLogger(__name__)
+
+
+def backfill(cursor):
+    """
+    Fills empty rollups from existing orders. Run by migrate.py, on a cursor inside its transaction.
+    """
+    cursor.execute(q.ROLLUPS_EMPTY)
+    if cursor.fetchone()[0]:
+        cursor.execute(q.BACKFILL_ROLLUPS, (SHARDS, ))
+        log.info("Filled the analytics rollups from existing orders")
+
+
+async def record(connection, order_ids):
+    """
+    Adds just placed orders to the rollups, inside the transaction that inserted them.
+    """
+    if order_ids:
+        await connection.execute(q.ADD_ORDERS_TO_ROLLUPS, (SHARDS, list(order_ids)))
+
+
+async def close(connection, table_id):
+    """
+    Marks one order on table_id as no longer open, inside the transaction that cleared it.
+    """
+    if table_id is not None:
+        await connection.execute(q.CLOSE_TABLE_ROLLUP, (table_id, ))
+
+
+def hour_range(since=None, until=None):
+    """
+    Whole hours from since up to until, by default the last DEFAULT_HOURS. Raises ValueError for a range that is
+    backwards or longer than MAX_HOURS.
+    """
+    until = aware(until) if until else datetime.now(timezone.utc)
+    since = aware(since) if since else until - timedelta(hours=DEFAULT_HOURS)
+    since = since.replace(minute=0, second=0, microsecond=0)
+    if since >= until:
+        raise ValueError("since must be before until")
+    if until - since > timedelta(hours=MAX_HOURS):
+        raise ValueError(f"At most {MAX_HOURS} hours at a time")
+    return since, until
+
+
+def table_to_json(row):
+    return {'table_id': row.table_id, 'covers': row.orders, 'open_orders': row.open_orders, 'items': row.items}
+
+
+def food_to_json(row):
+    return {'food_id': row.food_id, 'quantity': row.quantity, 'orders': row.orders}
+
+
+def hour_to_json(row):
+    return {'hour': row.hour, 'orders': row.orders, 'items': row.items}
@@ -1,32 +1,61 @@
 # Imported Modules
-import os
+# Modules read their settings from the environment at import, so .env is loaded before any of them
 from dotenv import load_dotenv
+load_dotenv()
+
+# startup goes next so it can time everything imported after it
+import startup
+import os
 from fastapi.security import OAuth2PasswordBearer
-from jose import jwt, JWTError
-from models import Order
-from fastapi import Depends, FastAPI, Request, HTTPException, status
+from models import Booking, Order
+from fastapi import Body, Depends, FastAPI, Header, Request, Response, HTTPException, Query, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.exceptions import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from psycopg2 import errors
 from pydantic import BaseModel
-from psycopg2 import pool
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
 #import jwt 
-import uvicorn
 import asyncio
+import json
+import logging
+import time
+import uuid
 
 # Local Modules
 import queries as q
+import logger
+import admission
+import analytics
+import auth
+import db
+import metrics
 import pool
-# from logging.handlers import RotatingFileHandler - stupid Vercel
-
-load_dotenv()
-SECRET_KEY=os.getenv('SECRET_KEY')
+import orders as o
+import export
+import pagination
+import cache
+import coordination
+import events
+import idempotency
+import migrate
+import replicas
+import search
+from loader import Loader, group_rows
+from responses import FastJSONResponse
+from allocator import AvailabilityIndex
+from bookings import BookingIndex, aware
+from scheduler import ExpiryScheduler
+
+logger.setup()
+log = logging.getLogger("app")
+access_log = logging.getLogger(logger.ACCESS_LOGGER)
 
 app = FastAPI()
 
-# global variable to store and track running asynchronous tasks
-
-TASK_DICT = dict()
+# How long a reservation holds a table before it is reset automatically. Lower it for testing.
+RESERVATION_LENGTH = timedelta(seconds=int(os.getenv('RESERVATION_SECONDS', 3600)))
 
 # origins = [
 #     "http://localhost/*",
@@ -36,6 +65,32 @@ TASK_DICT = dict()
 #     "https://rapid-ui.vercel.app/*"
 # ]
 
+# Which requests give way first when the database is saturated, see admission.py
+ROUTE_PRIORITIES = {
+    ('POST', '/table/set/{table_number}'): admission.CRITICAL,
+    ('POST', '/table/clear/{table_number}'): admission.CRITICAL,
+    ('POST', '/table/allocate/{party_size}'): admission.CRITICAL,
+    ('POST', '/booking/set'): admission.CRITICAL,
+    ('POST', '/booking/{booking_id}/clear'): admission.CRITICAL,
+    ('POST', '/order/place'): admission.CRITICAL,
+    ('POST', '/orders/place'): admission.CRITICAL,
+    ('POST', '/order/{order_id}/clear'): admission.CRITICAL,
+    ('GET', '/table'): admission.BULK,
+    ('GET', '/users'): admission.BULK,
+    ('GET', '/customer'): admission.BULK,
+    ('GET', '/orders'): admission.BULK,
+    ('GET', '/'): None,
+    ('GET', '/startup'): None,
+    ('GET', '/metrics'): None,
+    ('GET', '/events/table'): None,
+}
+
+admission_control = admission.Admission(db.pressure)
+
+# Inside CORS, so a rejected request still carries the CORS headers the tablets need to read it
+app.add_middleware(admission.AdmissionMiddleware, admission=admission_control, routes=app.routes,
+                   priorities=ROUTE_PRIORITIES, buckets=admission.TokenBuckets() if admission.RATE_LIMIT > 0 else None)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -43,6 +98,37 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+
+@app.middleware("http")
+async def assign_request_id(request: Request, call_next):
+    # Reuses the id from a proxy in front of us if there is one, so log lines can be matched across both
+    request_id = request.headers.get('x-request-id') or uuid.uuid4().hex
+    logger.request_id.set(request_id)
+    started = time.perf_counter()
+    response = await call_next(request)
+    response.headers['X-Request-ID'] = request_id
+    access_log.info("request", extra={'method': request.method, 'path': request.url.path,
+                                      'status': response.status_code,
+                                      'duration_ms': round((time.perf_counter() - started) * 1000, 2)})
+    return response
+
+@app.middleware("http")
+async def remember_client(request: Request, call_next):
+    # Identifies the caller for read-your-writes on the replica. Tablets can send a stable X-Client-Id
+    client = request.headers.get('x-client-id') or (request.client.host if request.client else None)
+    replicas.current_client.set(client)
+    return await call_next(request)
+
+@app.middleware("http")
+async def time_first_response(request: Request, call_next):
+    response = await call_next(request)
+    if startup.mark_response():
+        log.info("startup", extra={'startup': startup.report()})
+    return response
+
+# Registered last so it is the outermost layer, and its timings include every middleware above
+app.add_middleware(metrics.MetricsMiddleware)
+
 """
 This route is the base route for API
 
@@ -53,6 +139,58 @@ This route is the base route for API
 def root():
     return {"status":"Rapid Reservation API is running"}
 
+"""
+This route reports how long the app took to import and to serve its first response.
+Run with STARTUP_TIMING=1 to include the slowest module imports.
+"""
+@app.get("/startup")
+def startup_report():
+    return startup.report()
+
+def pool_metrics():
+    samples = []
+    stats = {}
+    # Only pools that have been opened, so a scrape doesn't defeat lazy startup
+    for role, opened in (("primary", pool._pool), ("replica", pool._replica_pool)):
+        if opened is None:
+            continue
+        for key, value in opened.stats().items():
+            stats.setdefault(key, {})[(("pool", role), )] = value
+        samples.append((f"db_pool_{role}_wait_seconds", "histogram", "Time spent waiting for a connection", opened.wait_time))
+        samples.append((f"db_pool_{role}_checkout_seconds", "histogram", "Time a connection is held", opened.checkout_time))
+    for key, values in stats.items():
+        kind = "gauge" if key in ("size", "idle", "in_use", "waiting") else "counter"
+        samples.append((f"db_pool_{key}", kind, f"Connection pool {key}", values))
+    if db.router.enabled:
+        stats = db.router.stats()
+        samples.append(("db_replica_lag_seconds", "gauge", "Last measured replica lag", {(): stats['lag'] or 0}))
+        samples.append(("db_replica_reads_total", "counter", "Reads by target",
+                        {(("target", "replica"), ): stats['replica_reads'], (("target", "primary"), ): stats['primary_reads']}))
+    return samples
+
+metrics.register_collector(pool_metrics)
+
+def admission_metrics():
+    stats = admission_control.stats()
+    samples = [("admission_in_flight", "gauge", "Requests holding an admission slot", {(): stats['in_flight']}),
+               ("admission_queued", "gauge", "Requests waiting for an admission slot", {(): stats['queued']}),
+               ("db_pool_primary_recent_wait_seconds", "gauge", "Moving average of primary pool waits",
+                {(): db.pressure.average_wait()})]
+    for key in ('admitted', 'shed', 'rate_limited'):
+        samples.append((f"admission_{key}_total", "counter", f"Requests {key.replace('_', ' ')} by class",
+                        {(("class", name), ): value for name, value in stats[key].items()}))
+    return samples
+
+metrics.register_collector(admission_metrics)
+
+"""
+This route exposes request, query and pool metrics in the Prometheus text format.
+Query latency is execution time only, pool wait is reported separately.
+"""
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.render()
+
 
 """
 Authentication
@@ -68,17 +206,40 @@ class Token(BaseModel):
     token_type: str
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-load_dotenv()
 SECRET_KEY=os.getenv('SECRET_KEY')
 ALGORITHM=os.getenv('ALGORITHM')
 
+hasher = auth.Hasher()
+token_cache = auth.TokenCache()
+
+@app.on_event("shutdown")
+def stop_hasher():
+    hasher.shutdown()
+
+def overloaded():
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many logins, try again shortly",
+                         headers={"Retry-After": "1"})
+
+def seconds_left(payload):
+    # expires_at is written by /login as a naive UTC timestamp
+    try:
+        expires_at = datetime.fromisoformat(payload['expires_at'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (expires_at - datetime.utcnow()).total_seconds()
 
+# python-jose loads its crypto backends on import, so it is only imported once a token is actually handled
 def decode_token(token: str):
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+    from jose import jwt, JWTError
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=ALGORITHM)
-        return payload
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    token_cache.put(token, payload, seconds_left(payload))
+    return payload
 
 # Endpoint to retrieve user data using JWT token
 @app.get("/user/me")
@@ -89,13 +250,8 @@ async def read_user_info(token: str = Depends(oauth2_scheme)):
 @app.get("/user/username/{username}")
 async def check_username_exists(username: str):
     try:
-        # Get a database connection
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-
         # Execute the query to check if the username exists
-        cursor.execute(q.GET_USER_BY_USERNAME, (username,))
-        result = cursor.fetchall()
+        result = await db.fetchall(q.GET_USER_BY_USERNAME, (username,), readonly=True)
 
         # Check if any records were returned
         if result:
@@ -105,48 +261,46 @@ async def check_username_exists(username: str):
     except Exception as e:
         # Handle any errors
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # Make sure to release the database connection
-        pool.release_connection(connection)
 
 """
 Login route
 """
 @app.post('/login')
 async def login(request: Request):
-    try:
-        data = await request.json()
-        username = data.get('username')
-        password = data.get('password')
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.GET_USER_BY_USERNAME, (username,))
-        connection.commit()
-        user = cursor.fetchone()
-
-        if user:
-            if user[1] == username and user[2] == password:
-                token_data = {
-                    "user_id": user[0],
-                    "user_name": user[1],
-                    "isadmin": user[3],
-                    "expires_at": (datetime.utcnow() + timedelta(minutes=20)).isoformat()
-                }
-                jwt_token = jwt.encode(token_data, SECRET_KEY, algorithm=ALGORITHM)
-
-                response_data = {
-                    "message": "Login Successful",
-                    "user": {
-                        "user_id": user[0],
-                        "user_name": user[1],
-                        "isadmin": user[3]
-                    },
-                    "token": jwt_token
-                }
-                return response_data
-        raise HTTPException(status_code=401, detail="Incorrect username or password")
-    finally:
-        pool.release_connection(connection)
+    data = await request.json()
+    username = data.get('username')
+    password = data.get('password')
+    user = await db.fetchone(q.GET_USER_BY_USERNAME, (username,))
+
+    if user and password:
+        try:
+            verified = await hasher.verify(password, user.password)
+            if verified and not auth.is_hashed(user.password):
+                # Accounts created before hashing are upgraded the first time they log in
+                await db.execute(q.UPDATE_USER_PASSWORD, (await hasher.hash(password), user.user_id))
+        except auth.Overloaded:
+            raise overloaded()
+        if user.user_name == username and verified:
+            token_data = {
+                "user_id": user.user_id,
+                "user_name": user.user_name,
+                "isadmin": user.isadmin,
+                "expires_at": (datetime.utcnow() + timedelta(minutes=20)).isoformat()
+            }
+            from jose import jwt
+            jwt_token = jwt.encode(token_data, SECRET_KEY, algorithm=ALGORITHM)
+
+            response_data = {
+                "message": "Login Successful",
+                "user": {
+                    "user_id": user.user_id,
+                    "user_name": user.user_name,
+                    "isadmin": user.isadmin
+                },
+                "token": jwt_token
+            }
+            return response_data
+    raise HTTPException(status_code=401, detail="Incorrect username or password")
 
 
 
@@ -158,20 +312,220 @@ async def login(request: Request):
 
 
 """
-TABLES
+Pagination
+
+The list routes take limit, after and fields. Without any of them they return the full list as before. With limit
+or after they return one page as {"items": [...], "next": token}, and next is passed back as after for the
+following page. fields alone keeps the plain list but only with the named fields.
+"""
+Limit = Query(None, ge=1, le=pagination.MAX_LIMIT)
+
+def page_request(fields, after, limit, allowed):
+    """
+    Validates the pagination parameters.
+    Returns:
+        (fields, after_key, limit, paged)
+    """
+    try:
+        fields = pagination.parse_fields(fields, allowed)
+        after = pagination.decode_cursor(after) if after else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    paged = limit is not None or after is not None
+    return fields, after, (limit or pagination.DEFAULT_LIMIT) if paged else None, paged
+
+async def read_replica(query, params):
+    return await db.fetchall(query, params, readonly=True)
+
+async def list_page(listing, fields, after, limit):
+    fields, after, limit, paged = page_request(fields, after, limit, listing.columns)
+    _, records, next_key = await listing.page(read_replica, fields, after, limit)
+    return FastJSONResponse(pagination.envelope(records, next_key) if paged else records)
+
+"""
+Schema
+
+Tables, extensions and indexes are created by migrate.py, run once per deploy. Workers only check they are there
 """
 
+@app.on_event("startup")
+async def check_schema():
+    await migrate.check(db.fetchall)
+
 """
-This is the auto reset function
+Idempotency
 
+POST /table/set/{table_number} and POST /order/place accept an Idempotency-Key header. See idempotency.py
 """
-async def schedule_reset(table_number: int):
+IdempotencyKey = Header(None, alias='Idempotency-Key', max_length=idempotency.MAX_KEY_LENGTH)
+
+idempotency_store = idempotency.IdempotencyStore()
+
+@app.on_event("startup")
+async def setup_idempotency():
+    await idempotency_store.setup()
+
+@app.on_event("shutdown")
+async def stop_idempotency():
+    await idempotency_store.stop()
+
+async def idempotent(response, scope, key, request_hash, write):
+    """
+    Runs write through idempotency_store and marks replayed responses.
+    Returns:
+        (body, replayed)
+    """
     try:
-        await asyncio.sleep(3600) # Sleep for one hour. Change for testing.
-        clear_table(table_number)
-    except asyncio.CancelledError:
-        print(f"Reset canceled.")
-        raise
+        body, replayed = await idempotency_store.run(scope, key, request_hash, write)
+    except idempotency.Mismatch:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return body, replayed
+
+"""
+TABLES
+"""
+
+def table_to_json(row):
+    return {'table_id': row.table_id,'order_id': row.order_id, 'max_customer': row.max_customer, 'table_available': row.table_available}
+
+TABLE_FIELDS = ('table_id', 'order_id', 'max_customer', 'table_available')
+
+async def fetch_tables():
+    return await db.fetchall(q.GET_TABLE_INFO)
+
+async def fetch_table_batch(table_numbers):
+    return group_rows(await db.fetchall(q.SELECT_RESERVATIONS, (table_numbers,)), 'table_id')
+
+# Concurrent cache misses for the same or different tables share one query
+table_loader = Loader(fetch_table_batch, default=[])
+
+async def fetch_table(table_number):
+    return await table_loader.load(table_number)
+
+# Serves the table polling routes. Every write to public.table must invalidate what it touched
+table_cache = cache.TableCache(fetch_tables, fetch_table, key=lambda row: row.table_id, forget=table_loader.clear)
+
+# Free tables by capacity, for best-fit allocation. Kept in step with the same writes as table_cache
+availability = AvailabilityIndex()
+
+# Live table changes for /ws/table and /events/table subscribers
+table_events = events.Broadcaster()
+
+# Every committed change to a table's availability goes through one of these, so the expiry scheduler, the cache,
+# the allocation index and live subscribers all see it
+
+def table_reserved(table_number, expires_at):
+    expiries.schedule(table_number, expires_at)
+    table_cache.invalidate(table_number)
+    availability.take(table_number)
+    table_events.publish({'type': 'table', 'table_id': table_number, 'table_available': False})
+
+def table_cleared(table_number):
+    expiries.cancel(table_number)
+    table_cache.invalidate(table_number)
+    availability.release(table_number)
+    table_events.publish({'type': 'table', 'table_id': table_number, 'table_available': True})
+
+def all_tables_cleared():
+    expiries.cancel_all()
+    table_cache.invalidate_all()
+    availability.release_all()
+    table_events.publish({'type': 'clear_all', 'table_available': True})
+
+"""
+This is the auto reset function. The expiry scheduler calls it once a reservation has run for RESERVATION_LENGTH.
+
+"""
+async def expire_reservation(table_number: int, deadline: datetime):
+    async with db.transaction() as connection:
+        # Skip the reset if the reservation was cleared or renewed since the deadline was set
+        if not await connection.fetchone(q.TAKE_DUE_TABLE_EXPIRY, (table_number, deadline)):
+            return
+        await connection.execute(q.CLEAR_RESERVATION, (table_number,))
+        await coordinator.announce(connection, 'table_cleared', table_number=table_number)
+    table_cleared(table_number)
+
+# Tracks the pending expiry of every reserved table. With several workers each one tracks every table, and
+# TAKE_DUE_TABLE_EXPIRY lets exactly one of them do the reset
+expiries = ExpiryScheduler(expire_reservation)
+
+# Applies the other workers' table and booking changes to this worker's state, see coordination.py
+coordinator = coordination.Coordinator()
+
+@coordinator.on('table_reserved')
+def remote_table_reserved(table_number, expires_at):
+    table_reserved(table_number, datetime.fromisoformat(expires_at))
+
+@coordinator.on('table_cleared')
+def remote_table_cleared(table_number):
+    table_cleared(table_number)
+
+@coordinator.on('tables_cleared')
+def remote_tables_cleared():
+    all_tables_cleared()
+
+@coordinator.on('booking_added')
+def remote_booking_added(booking_id, table_id, start, end):
+    booking_index.add(booking_id, table_id, datetime.fromisoformat(start), datetime.fromisoformat(end))
+
+@coordinator.on('booking_removed')
+def remote_booking_removed(booking_id):
+    booking_index.remove(booking_id)
+
+async def resync_state():
+    # Events may have been missed while the listening connection was down, rebuild from the database
+    table_cache.invalidate_all()
+    rows, _ = await table_cache.all()
+    availability.load(rows)
+    expiries.cancel_all()
+    expiries.start(await db.fetchall(q.GET_TABLE_EXPIRIES))
+    booking_index.invalidate()
+    table_events.resync()
+
+coordinator.on_resync = resync_state
+
+def coordination_metrics():
+    if not coordinator.enabled:
+        return []
+    stats = coordinator.stats()
+    return [("coordination_events_received_total", "counter", "Change events applied from other workers", {(): stats['received']}),
+            ("coordination_resyncs_total", "counter", "State reloads after the listening connection dropped", {(): stats['resyncs']})]
+
+metrics.register_collector(coordination_metrics)
+
+@app.on_event("startup")
+async def start_coordinator():
+    # Listen before any state is loaded, so nothing committed in between is missed
+    await coordinator.start()
+
+@app.on_event("startup")
+async def start_expiries():
+    expiries.start(await db.fetchall(q.GET_TABLE_EXPIRIES))
+
+@app.on_event("startup")
+async def load_availability():
+    rows, _ = await table_cache.all()
+    availability.load(rows)
+
+@app.on_event("startup")
+async def watch_replica():
+    # Reads only move to the replica once the first lag check has passed
+    if db.router.enabled:
+        app.state.replica_monitor = asyncio.create_task(db.router.monitor(db.replica_lag))
+
+@app.on_event("shutdown")
+async def stop_expiries():
+    await expiries.stop()
+
+@app.on_event("shutdown")
+async def stop_coordinator():
+    await coordinator.stop()
+
+@app.on_event("shutdown")
+def flush_logs():
+    logger.stop()
 
 """
 This route is called when a table is reserved. Calls SET_RESERVATION script in queries.py
@@ -182,26 +536,27 @@ Returns:
     Error message on error
 """
 @app.post('/table/set/{table_number}')
-async def reserve_table(table_number: int):
+async def reserve_table(table_number: int, response: Response, idempotency_key: Optional[str] = IdempotencyKey):
     try:
-        connection = pool.get_connection()
         if table_number is not None:
-            cursor = connection.cursor()
-            cursor.execute(q.SET_RESERVATION, (table_number,))
-            connection.commit()
-            # TODO: Set BackgroundTask to wait 1 hour then reset the table
-            task = asyncio.create_task(schedule_reset(table_number))
-            TASK_DICT[table_number] = task
-            try:
-                await task
-            except asyncio.CancelledError:
-                print(f"Cancel was called")
-            return {'success': True, 'message': 'Table reserved successfully'}
+            expires_at = datetime.now(timezone.utc) + RESERVATION_LENGTH
+
+            async def reserve(connection):
+                await connection.execute(q.SET_RESERVATION, (table_number,))
+                await connection.execute(q.SET_TABLE_EXPIRY, (table_number, expires_at))
+                await coordinator.announce(connection, 'table_reserved', table_number=table_number, expires_at=expires_at)
+                return {'success': True, 'message': 'Table reserved successfully'}
+
+            body, replayed = await idempotent(response, 'table/set', idempotency_key, idempotency.fingerprint(table_number), reserve)
+            if not replayed:
+                # Hand the reset to the scheduler and answer straight away
+                table_reserved(table_number, expires_at)
+            return body
+    except HTTPException as e:
+        raise e
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
  
 """
 This route can be called to make a table ready to be reserved again. Calls CLEAR_RESERVATION in queries.py
@@ -212,26 +567,19 @@ Returns:
         Error message on Error
 """
 @app.post('/table/clear/{table_number}')
-def clear_table(table_number: int):
+async def clear_table(table_number: int):
 
     try:
-        connection = pool.get_connection()
         if table_number is not None:
-            cursor = connection.cursor()
-            cursor.execute(q.CLEAR_RESERVATION, (table_number,))
-            connection.commit()
-            # TODO: If table_number has an active countdown, it needs to be canceled
-            try:
-                task = TASK_DICT.pop(table_number)
-                task.cancel()
-            except:
-                pass
+            async with db.transaction() as connection:
+                await connection.execute(q.CLEAR_RESERVATION, (table_number,))
+                await connection.execute(q.CLEAR_TABLE_EXPIRY, (table_number,))
+                await coordinator.announce(connection, 'table_cleared', table_number=table_number)
+            table_cleared(table_number)
             return {'success': True, 'message': 'Table cleared successfully'}
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 """
 This route can be called to make all table ready to be reserved again. Calls CLEAR_ALL_RESERVATIONS in queries.py
@@ -242,30 +590,123 @@ Returns:
         Error message on Error
 """
 @app.post('/table/clear_all/')
-def clear_all_tables():
+async def clear_all_tables():
 
     try:
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.CLEAR_ALL_RESERVATIONS)
-        connection.commit()
-        # TODO: Cancel all active countdowns
-        try:
-            for this_task in TASK_DICT.values():
-                task = this_task
-                task.cancel()
-            TASK_DICT.clear()
-        except:
-            pass
+        async with db.transaction() as connection:
+            await connection.execute(q.CLEAR_ALL_RESERVATIONS)
+            await connection.execute(q.CLEAR_ALL_TABLE_EXPIRIES)
+            await coordinator.announce(connection, 'tables_cleared')
+        all_tables_cleared()
         return {'success': True, 'message': 'Tables all cleared successfully'}
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
+
+"""
+This route seats a party at the smallest free table whose max_customer fits it, and reserves that table the same
+way /table/set does. Calls ALLOCATE_TABLE in queries.py
+
+Returns:
+        JSON with the reserved table_id on success
+
+        409 when no free table fits the party
+"""
+@app.post('/table/allocate/{party_size}')
+async def allocate_table(party_size: int):
+    if party_size < 1:
+        raise HTTPException(status_code=400, detail="Party size must be at least 1")
+    try:
+        expires_at = datetime.now(timezone.utc) + RESERVATION_LENGTH
+        table_number = None
+        for attempt in range(2):
+            candidates = availability.candidates(party_size)
+            if candidates:
+                async with db.transaction() as connection:
+                    row = await connection.fetchone(q.ALLOCATE_TABLE, (party_size, candidates, expires_at))
+                    if row:
+                        await coordinator.announce(connection, 'table_reserved', table_number=row.table_id, expires_at=expires_at)
+                if row:
+                    table_number = row.table_id
+                    break
+            # Either nothing fits or the index was out of date, reload it and look once more
+            rows, _ = await table_cache.all()
+            availability.load(rows)
+
+        if table_number is None:
+            raise HTTPException(status_code=409, detail="No available table fits the party")
+
+        table_reserved(table_number, expires_at)
+        return {'success': True, 'message': 'Table reserved successfully', 'table_id': table_number}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        log.exception("Error: %s", e)
+        return {'error': 'Internal Server Error'}, 500
+
+async def table_snapshot():
+    rows, _ = await table_cache.all()
+    return json.dumps({'type': 'snapshot', 'tables': [table_to_json(row) for row in rows]})
+
+"""
+This WebSocket pushes table availability as it changes, instead of clients polling GET /table.
+The first message is a snapshot of every table, after that one message per change:
+    {"type": "table", "table_id": 3, "table_available": false}
+    {"type": "clear_all", "table_available": true}
+    {"type": "resync"} when the client fell behind and should treat the next snapshot as fresh state
+"""
+@app.websocket('/ws/table')
+async def table_updates(websocket: WebSocket):
+    await websocket.accept()
+    # Subscribe before taking the snapshot so no change can slip in between
+    with table_events.subscribe() as queue:
+        # Reading from the socket is what notices a client that went away while there was nothing to send it
+        receiving = asyncio.ensure_future(websocket.receive())
+        waiting = asyncio.ensure_future(queue.get())
+        try:
+            await websocket.send_text(await table_snapshot())
+            while True:
+                await asyncio.wait((receiving, waiting), return_when=asyncio.FIRST_COMPLETED)
+                if receiving.done():
+                    if receiving.result()["type"] == "websocket.disconnect":
+                        break
+                    # Nothing is expected from the client, anything it sends is ignored
+                    receiving = asyncio.ensure_future(websocket.receive())
+                if waiting.done():
+                    message = waiting.result()
+                    waiting = asyncio.ensure_future(queue.get())
+                    await websocket.send_text(message)
+                    if message == events.RESYNC:
+                        await websocket.send_text(await table_snapshot())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            receiving.cancel()
+            waiting.cancel()
+
+"""
+The same stream as /ws/table, as Server-Sent Events for clients that can't hold a WebSocket.
+"""
+@app.get('/events/table')
+async def table_event_stream():
+    async def stream():
+        with table_events.subscribe() as queue:
+            yield events.sse(await table_snapshot())
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), 15)
+                except asyncio.TimeoutError:
+                    # Comment line as a heartbeat, keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield events.sse(message)
+                if message == events.RESYNC:
+                    yield events.sse(await table_snapshot())
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 """
 This route is used to check the current status of a given table. Calls SELECT_RESERVATION from queries.py
+Answered from table_cache, and with a 304 when If-None-Match already matches the table's ETag
 
 Returns:
     Json with table information on success
@@ -273,26 +714,29 @@ Returns:
     Error message on error
 """
 @app.get('/table/{table_number}')
-# @cache.cached(timeout=60)
-def check_reservation(table_number: int):
+async def check_reservation(table_number: int, request: Request, response: Response):
     try:
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.SELECT_RESERVATION, (table_number,))
-        result = cursor.fetchall()
+        etag = table_cache.table_etag(table_number)
+        if etag and cache.etag_matches(request, etag):
+            return cache.not_modified(etag)
+        result, etag = await table_cache.one(table_number)
+        if etag:
+            response.headers['ETag'] = etag
 
-        table = [{'table_id': row[2],'order_id': row[0], 'max_customer': row[1], 'table_available': row[3]} for row in result]
+        table = [table_to_json(row) for row in result]
 
         return table
 
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 """
 This route is used to pull all the data from all the tables. Calls GET_TABLE_INFO from queries.py
+Answered from table_cache, and with a 304 when If-None-Match already matches the list's ETag
+
+Args:
+    format: optional, "ndjson" or "csv" streams the tables as an export instead
 
 Returns:
     JSON of all table data on success
@@ -300,67 +744,177 @@ Returns:
     Fail message on Failure
 """
 @app.get('/table')
-def get_table_info():
+async def get_table_info(request: Request, export_format: Optional[str] = Query(None, alias='format', pattern=export.FORMAT_PATTERN),
+                         limit: Optional[int] = Limit, after: Optional[str] = None, fields: Optional[str] = None):
+    if export_format:
+        return export.stream(q.GET_TABLE_INFO, table_to_json, export_format, 'tables')
+    fields, after, limit, paged = page_request(fields, after, limit, TABLE_FIELDS)
     tables = {}
     try:
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.GET_TABLE_INFO)
-        results = cursor.fetchall()
-        
-        tables = [{'table_id': row[2],'order_id': row[0], 'max_customer': row[1], 'table_available': row[3]} for row in results]
-        return tables
+        etag = table_cache.etag
+        if etag and cache.etag_matches(request, etag):
+            return cache.not_modified(etag)
+        results, etag = await table_cache.all()
+        headers = {'ETag': etag} if etag else None
+
+        # The table list is already cached in table_id order, so pages are cut from it without a query
+        results, next_key = pagination.slice_sorted(results, lambda row: row.table_id, after, limit)
+        tables = [pagination.project(table_to_json(row), fields) for row in results]
+        return FastJSONResponse(pagination.envelope(tables, next_key) if paged else tables, headers=headers)
     
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
+        return {'error': 'Internal Server Error'}, 500
+
+"""
+BOOKINGS
+"""
+
+# Upcoming bookings per table, read from public.booking by the first booking request
+booking_index = BookingIndex()
+
+async def fetch_upcoming_bookings():
+    return await db.fetchall(q.GET_UPCOMING_BOOKINGS)
+
+async def table_capacities():
+    rows, _ = await table_cache.all()
+    return {row.table_id: row.max_customer for row in rows}
+
+"""
+This route lists the tables that seat a party and have no booking overlapping the requested slot. Answered from
+booking_index without a query once the table list is cached.
+
+Returns:
+    JSON list of free tables, smallest first, on success
+
+    Error message on error
+"""
+@app.get('/booking/available')
+async def available_tables(start: datetime, end: datetime, party_size: int = Query(..., gt=0)):
+    if aware(end) <= aware(start):
+        raise HTTPException(status_code=400, detail="end must be after start")
+    try:
+        await booking_index.ensure_loaded(fetch_upcoming_bookings)
+        capacities = await table_capacities()
+        return FastJSONResponse([{'table_id': table_id, 'max_customer': capacities[table_id]}
+                                 for table_id in booking_index.free_tables(capacities, party_size, start, end)])
+    except Exception as e:
+        log.exception("Error: %s", e)
+        return {'error': 'Internal Server Error'}, 500
+
+"""
+This route books a table for a future time slot. Calls CREATE_BOOKING in queries.py
+
+Returns:
+    JSON with the new booking_id on success
+
+    409 if the table is already booked for part of that slot
+"""
+@app.post('/booking/set')
+async def book_table(booking: Booking):
+    if aware(booking.end) <= aware(booking.start):
+        raise HTTPException(status_code=400, detail="end must be after start")
+    try:
+        await booking_index.ensure_loaded(fetch_upcoming_bookings)
+        capacity = (await table_capacities()).get(booking.table_id)
+        if capacity is None:
+            raise HTTPException(status_code=404, detail="Table not found")
+        if booking.party_size > capacity:
+            raise HTTPException(status_code=400, detail=f"Table {booking.table_id} seats at most {capacity}")
+        # Quick answer from the index. The exclusion constraint still decides races
+        if not booking_index.is_free(booking.table_id, booking.start, booking.end):
+            raise HTTPException(status_code=409, detail="Table is already booked for that time")
+
+        start, end = aware(booking.start), aware(booking.end)
+        try:
+            async with db.transaction() as connection:
+                row = await connection.fetchone(q.CREATE_BOOKING, (booking.table_id, booking.customer_id, booking.party_size, start, end))
+                await coordinator.announce(connection, 'booking_added', booking_id=row.booking_id, table_id=booking.table_id, start=start, end=end)
+        except errors.ExclusionViolation:
+            raise HTTPException(status_code=409, detail="Table is already booked for that time")
+
+        booking_index.add(row.booking_id, booking.table_id, start, end)
+        booking_index.prune()
+        return {'success': True, 'message': 'Table booked successfully', 'booking_id': row.booking_id}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        log.exception("Error: %s", e)
+        return {'error': 'Internal Server Error'}, 500
+
+"""
+This route cancels a booking. Calls CANCEL_BOOKING in queries.py
+
+Returns:
+    Success message on success
+
+    404 if there is no such booking
+"""
+@app.post('/booking/{booking_id}/clear')
+async def cancel_booking(booking_id: int):
+    try:
+        async with db.transaction() as connection:
+            row = await connection.fetchone(q.CANCEL_BOOKING, (booking_id,))
+            if row:
+                await coordinator.announce(connection, 'booking_removed', booking_id=booking_id)
+        if not row:
+            raise HTTPException(status_code=404, detail="Booking not found")
+        booking_index.remove(booking_id)
+        return {'success': True, 'message': f'Booking {booking_id} cleared successfully'}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 """
 USERS
 """
+def user_to_json(row):
+    return {"user_id": row.user_id, "user_name": row.user_name, "password": row.password, "isadmin": row.isadmin}
+
+user_listing = pagination.Listing('users', 'public.user', 'user_id', {
+    'user_id': 'user_id', 'user_name': 'user_name', 'password': 'password', 'isadmin': 'isadmin'})
+
 @app.get('/users')
-def get_user():
+async def get_user(export_format: Optional[str] = Query(None, alias='format', pattern=export.FORMAT_PATTERN),
+                   limit: Optional[int] = Limit, after: Optional[str] = None, fields: Optional[str] = None):
     """
-
+    Pass format=ndjson or format=csv to stream the users as an export. limit, after and fields page and narrow the
+    list, see Pagination above.
     """
+    if export_format:
+        return export.stream(q.GET_ALL_USERS, user_to_json, export_format, 'users')
     users={}
     try:
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.GET_ALL_USERS)
-        results = cursor.fetchall()
+        if limit or after or fields:
+            return await list_page(user_listing, fields, after, limit)
+        results = await db.fetchall(q.GET_ALL_USERS, readonly=True)
         
-        return [{"user_id": row[0], "user_name": row[1], "password": row[2], "isadmin": row[3]} for row in results]
+        return FastJSONResponse([user_to_json(row) for row in results])
 
     
+    except HTTPException as e:
+        raise e
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 @app.get('/customer/id/{email}')
-def get_user_by_email(email: str):
+async def get_user_by_email(email: str):
     """
 
     """
     user={}
     try:
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.GET_CUSTOMER_ID_BY_EMAIL, (email,))
-        results = cursor.fetchall()
+        results = await customer_id_loader.load(email)
         
-        return [{"user_id": row[0]} for row in results]
+        return [{"user_id": row.customer_id} for row in results]
 
     
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 @app.post('/users/create')
 async def new_customer(request: Request):
@@ -378,50 +932,105 @@ async def new_customer(request: Request):
         user_name = data.get('user_name')
         password = data.get('password')
         isadmin = data.get('isadmin')
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.CREATE_NEW_USER, ((user_id, user_name, password,isadmin)))
-        connection.commit()
+        password = await hasher.hash(password)
+        await db.execute(q.CREATE_NEW_USER, ((user_id, user_name, password,isadmin)))
         return {'success': True, 'message': 'User {user_id} added successfully'}
+    except auth.Overloaded:
+        raise overloaded()
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         raise HTTPException(status_code=500, detail='Internal Server Error')
 
 """
 CUSTOMERS
 """
 
+async def fetch_customer_batch(customer_ids):
+    return group_rows(await db.fetchall(q.GET_CUSTOMERS_BY_IDS, (customer_ids,)), 'customer_id')
+
+async def fetch_customer_id_batch(emails):
+    return group_rows(await db.fetchall(q.GET_CUSTOMER_IDS_BY_EMAILS, (emails,)), 'customer_email')
+
+customer_loader = Loader(fetch_customer_batch, default=[])
+customer_id_loader = Loader(fetch_customer_id_batch, default=[])
+
+def customer_to_json(row):
+    return {'customer_id': row.customer_id,'customer_name': row.customer_name, 'customer_address': row.customer_address, 'customer_phone': row.customer_phone, 'customer_email': row.customer_email}
+
+customer_listing = pagination.Listing('customers', 'public.customer', 'customer_id', {
+    'customer_id': 'customer_id', 'customer_name': 'customer_name', 'customer_address': 'customer_address',
+    'customer_phone': 'customer_phone', 'customer_email': 'customer_email'})
+
 @app.get('/customer')
-def get_customer_info():
+async def get_customer_info(export_format: Optional[str] = Query(None, alias='format', pattern=export.FORMAT_PATTERN),
+                            limit: Optional[int] = Limit, after: Optional[str] = None, fields: Optional[str] = None):
     """
     This route is used to pull all the data from all the customers. Calls GET_ALL_CUSTOMERS from queries.py
+    Args:
+        format: optional, "ndjson" or "csv" streams the customers as an export instead
+        limit, after, fields: page and narrow the list, see Pagination above
 
     Returns:
         Json of all customer data on success
 
         Fail message on Failure
     """
+    if export_format:
+        return export.stream(q.GET_ALL_CUSTOMERS, customer_to_json, export_format, 'customers')
     customers = {}
     try:
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.GET_ALL_CUSTOMERS)
-        results = cursor.fetchall()
+        if limit or after or fields:
+            return await list_page(customer_listing, fields, after, limit)
+        results = await db.fetchall(q.GET_ALL_CUSTOMERS, readonly=True)
+
+        customers = [customer_to_json(row) for row in results]
+        return FastJSONResponse(customers)
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        log.exception("Error: %s", e)
+        return {'error': 'Internal Server Error'}, 500
+
+# Prefix and fuzzy lookups for the host stand, reading from the replica when it can
+customer_search = search.CustomerSearch(read_replica)
+
+def search_metrics():
+    stats = customer_search.stats()
+    return [("customer_search_hot_set", "gauge", "Customers in the in-memory prefix index", {(): stats['hot_set']}),
+            ("customer_search_total", "counter", "Searches by what answered them",
+             {(("source", "index"), ): stats['index_answers'], (("source", "database"), ): stats['queries']})]
+
+metrics.register_collector(search_metrics)
 
-        customers = [{'customer_id': row[4],'customer_name': row[0], 'customer_address': row[1], 'customer_phone': row[2], 'customer_email': row[3]} for row in results]
-        return customers
+@app.get('/customer/search')
+async def search_customers(term: str = Query(..., alias='q', min_length=search.MIN_LENGTH),
+                           limit: int = Query(search.DEFAULT_LIMIT, ge=1, le=search.MAX_LIMIT)):
+    """
+    This route finds customers by part of their name, phone number or email, tolerating typos. Calls SEARCH_CUSTOMERS
+    from queries.py unless the in-memory index of regulars already has enough prefix matches
+    Args:
+        q: what was typed, at least two characters
+        limit: optional, most results to return
+
+    Returns:
+        Json list of customers, best match first, each with a score between 0 and 1
 
+        Error message on error
+    """
+    try:
+        results = await customer_search.search(term.strip(), limit)
+        return FastJSONResponse([{**customer_to_json(row), 'score': round(score, 3)} for row, score in results])
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 
 @app.get('/customer/{customer_id}')
-def get_one_customer_info(customer_id):
+async def get_one_customer_info(customer_id: int):
     """
-    This route is used to return a single customers information. Calls GET_CUSTOMER_BY_ID from queries.py
+    This route is used to return a single customers information. Calls GET_CUSTOMERS_BY_IDS from queries.py through
+    customer_loader, so concurrent lookups are batched into one query
     Returns:
 
         Json with customer information on success
@@ -429,19 +1038,14 @@ def get_one_customer_info(customer_id):
         Error message on error
     """
     try:
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.GET_CUSTOMER_BY_ID, (customer_id,))
-        result = cursor.fetchall()
+        result = await customer_loader.load(customer_id)
 
-        customer = [{'customer_id': row[4],'customer_name': row[0], 'customer_address': row[1], 'customer_phone': row[2], 'customer_email': row[3]} for row in result]
+        customer = [customer_to_json(row) for row in result]
         return customer
 
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 
 @app.post('/customer/set')
@@ -462,66 +1066,74 @@ async def new_customer(request: Request):
         customer_address = sanitize(data.get('customer_address'))
         customer_phone = sanitize(data.get('customer_phone'))
         customer_email = sanitize(data.get('customer_email'))
-        print(customer_name + customer_address + customer_phone + customer_email)
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.CREATE_NEW_CUSTOMER, (customer_name, customer_address, customer_phone, customer_email,))
-        connection.commit()
+        await db.execute(q.CREATE_NEW_CUSTOMER, (customer_name, customer_address, customer_phone, customer_email,))
         return {'success': True, 'message': 'Customer added successfully'}
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         raise HTTPException(status_code=500, detail='Internal Server Error')
     
 """
 ORDERS
 """
 
+async def fetch_order_batch(order_ids):
+    async with db.connection() as connection:
+        orders = await connection.fetchall(q.GET_ORDERS_BY_IDS, (order_ids,))
+        order_items = await connection.fetchall(q.GET_ORDER_ITEMS_BY_IDS, (order_ids,))
+    grouped = o.group_order_items(order_items)
+    return {row.order_id: (row, grouped.get(row.order_id, [])) for row in orders}
+
+# Resolves order_id -> (order row, item rows), or None for a missing order
+order_loader = Loader(fetch_order_batch)
+
+# items isn't a column, it is filled in from order_items for just the orders on the page
+order_listing = pagination.Listing('orders', 'public.order', 'order_id', {
+    'order_id': 'order_id', 'table_number': 'table_id', 'customer_id': 'customer_id', 'items': None})
+
+async def order_page(fields, after, limit):
+    fields, after, limit, paged = page_request(fields, after, limit, order_listing.columns)
+    async with db.connection(readonly=True) as connection:
+        order_ids, records, next_key = await order_listing.page(connection.fetchall, fields, after, limit)
+        if 'items' in fields:
+            grouped = o.group_order_items(await connection.fetchall(q.GET_ORDER_ITEMS_BY_IDS, (order_ids,)))
+            for order_id, record in zip(order_ids, records):
+                record['items'] = o.order_items_to_json(grouped.get(order_id, ()))
+    records = [pagination.project(record, fields) for record in records]
+    return FastJSONResponse(pagination.envelope(records, next_key) if paged else records)
+
 @app.get("/orders")
-def get_orders():
+async def get_orders(export_format: Optional[str] = Query(None, alias='format', pattern=export.FORMAT_PATTERN),
+                     limit: Optional[int] = Limit, after: Optional[str] = None, fields: Optional[str] = None):
     """
   This route retrieves information about all orders.
 
+  Args:
+      format: optional, "ndjson" or "csv" streams the orders as an export instead
+      limit, after, fields: page and narrow the list, see Pagination above
   Returns:
       JSON with a list of order details on success.
 
       Error message on failure.
   """
+    if export_format:
+        return export.stream(q.EXPORT_ALL_ORDERS, o.exported_order_to_json, export_format, 'orders')
     try:
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.GET_ALL_ORDERS)
-        orders = cursor.fetchall()
-        cursor.execute(q.GET_ALL_ORDER_ITEMS)
-        order_items = cursor.fetchall()
-        return [
-            {
-                "order_id": row[6],
-                "table_number": row[1],
-                "customer_id": row[0],
-                # Grab all of the food items and quantities from the ORDER_ITEMS table
-                # add only those which belong to the current order_id
-                "items": [
-                    {
-                        "food_id": order_item[0],
-                        "quantity": order_item[2]
-                    }
-
-                    for order_item in order_items
-                    if order_item[1] == row[6]
-                ]
-            }
-
-            for row in orders
-        ]
+        if limit or after or fields:
+            return await order_page(fields, after, limit)
+        async with db.connection(readonly=True) as connection:
+            orders = await connection.fetchall(q.GET_ALL_ORDERS)
+            order_items = await connection.fetchall(q.GET_ALL_ORDER_ITEMS)
+        # Group the food items by order_id once, then attach each order's bucket
+        return FastJSONResponse(o.assemble_orders(orders, order_items))
+    except HTTPException as e:
+        raise e
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 
 @app.get("/order/{order_id}")
-def get_order(order_id: int):
+async def get_order(order_id: int):
     """
   This route retrieves information about a specific order.
 
@@ -534,109 +1146,155 @@ def get_order(order_id: int):
   """
 
     try:
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.GET_ORDER_BY_ID, (order_id, ))
-        order = cursor.fetchone()
-        if order:
-            cursor.execute(q.GET_ORDER_ITEMS_BY_ID, (order_id, ))
-            order_items = cursor.fetchall()
-            return {
-                "order_id": order[6],
-                "table_number": order[1],
-                "customer_id": order[0],
-                "items": [
-                    {
-                        "food_id": order_item[0],
-                        "quantity": order_item[2]
-                    }
-
-                    for order_item in order_items
-                ]
-            }
+        found = await order_loader.load(order_id)
+        if found:
+            return o.order_to_json(*found)
         else:
             raise HTTPException(status_code=404, detail="Order not found")
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 
 @app.post("/order/place")
-async def place_order(request: Request, order: Order):
+async def place_order(request: Request, order: Order, response: Response, idempotency_key: Optional[str] = IdempotencyKey):
     """
   This route creates a new order.
 
   Args:
       request: The request object containing order details.
+      Idempotency-Key: optional header. A retry with the same key gets the first response back instead of a second order
   Returns:
       JSON with success message on success.
 
       Error message on failure.
   """
     try:
-        # Quick duplicate filter for order items
-        # Will throw away an order item if it's associated food id is already present to avoid errors
-        food_item_ids = []
-        unique_food_items = []
-        for order_item in order.items:
-            if order_item.food_id not in food_item_ids:
-                unique_food_items.append(order_item)
-                food_item_ids.append(order_item.food_id)
-        
-        order.items = unique_food_items
+        # The order and all of its items land in one transaction, or not at all
+        async def place(connection):
+            order_id = await connection.run(o.write_order, order)
+            await analytics.record(connection, [order_id])
+            return {'success': True, 'message': 'Order placed successfully', 'order_id': order_id}
+
+        body, _ = await idempotent(response, 'order/place', idempotency_key, idempotency.fingerprint(order.model_dump()), place)
+        return body
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        log.exception("Error: %s", e)
+        return {'error': 'Internal Server Error'}, 500
+
+
+@app.post("/orders/place")
+async def place_orders(orders: List[Order] = Body(..., max_length=o.MAX_BATCH)):
+    """
+  This route creates many orders at once, for POS terminals syncing an offline queue.
+  All of the orders are written in one transaction, so a failure leaves none of them behind.
 
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        # Add order to 'public.order' table
-        cursor.execute(q.CREATE_ORDER, (order.customer_id, order.table_number, ))
-        order_id = cursor.fetchone()
-        connection.commit()
+  Args:
+      orders: JSON list of at most ORDERS_MAX_BATCH orders, each shaped like the body of /order/place
+  Returns:
+      JSON with success message and the new order ids, in request order, on success.
 
-        # Add each food item to 'public.order_items' table
-        for order_item in order.items:
-            cursor.execute(q.CREATE_ORDER_ITEM, (order_item.food_id, order_id, order_item.quantity, ))
-            connection.commit()
+      Error message on failure.
+  """
+    try:
+        async with db.transaction() as connection:
+            order_ids = await connection.run(o.write_orders, orders)
+            await analytics.record(connection, order_ids)
 
-        return {'success': True, 'message': 'Order placed successfully'}
+        return {'success': True, 'message': f'{len(order_ids)} orders placed successfully', 'order_ids': order_ids}
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 
 @app.post('/orders/clear')
-def clear_all_orders():
+async def clear_all_orders():
     try:
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.CLEAR_ALL_ORDERS)
-        connection.commit()
+        async with db.transaction() as connection:
+            await connection.execute(q.CLEAR_ALL_ORDERS)
+            await connection.execute(q.CLOSE_ALL_TABLE_ROLLUPS)
         return {'success': True, 'message': 'All orders all cleared successfully'}
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 
 @app.post('/order/{order_id}/clear')
-def clear_order(order_id: int):
+async def clear_order(order_id: int):
     try:
-        connection = pool.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(q.CLEAR_ORDER, (order_id, ))
-        connection.commit()
+        async with db.transaction() as connection:
+            row = await connection.fetchone(q.CLEAR_ORDER, (order_id, ))
+            if row:
+                await analytics.close(connection, row.table_id)
         return {'success': True, 'message': f'Order {order_id} cleared successfully'}
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error: %s", e)
+        return {'error': 'Internal Server Error'}, 500
+
+
+"""
+ANALYTICS
+"""
+
+@app.get('/analytics/tables')
+async def table_analytics():
+    """
+    This route reports covers, items and open orders per table. Calls GET_TABLE_ROLLUP from queries.py
+    Returns:
+        Json list of tables on success
+
+        Error message on error
+    """
+    try:
+        rows = await db.fetchall(q.GET_TABLE_ROLLUP, readonly=True)
+        return FastJSONResponse([analytics.table_to_json(row) for row in rows])
+    except Exception as e:
+        log.exception("Error: %s", e)
+        return {'error': 'Internal Server Error'}, 500
+
+@app.get('/analytics/foods')
+async def food_analytics(limit: int = Query(analytics.DEFAULT_FOODS, ge=1, le=pagination.MAX_LIMIT)):
+    """
+    This route reports how much of each food_id has been sold, best sellers first. Calls GET_FOOD_ROLLUP from queries.py
+    Args:
+        limit: optional, how many foods to return
+    Returns:
+        Json list of foods on success
+
+        Error message on error
+    """
+    try:
+        rows = await db.fetchall(q.GET_FOOD_ROLLUP, (limit, ), readonly=True)
+        return FastJSONResponse([analytics.food_to_json(row) for row in rows])
+    except Exception as e:
+        log.exception("Error: %s", e)
+        return {'error': 'Internal Server Error'}, 500
+
+@app.get('/analytics/hourly')
+async def hourly_analytics(since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """
+    This route reports orders and items per hour. Calls GET_HOURLY_ROLLUP from queries.py
+    Args:
+        since, until: optional, the range to report. Defaults to the last 24 hours. Naive values are taken as UTC
+    Returns:
+        Json list of the hours that had orders, oldest first, on success
+
+        Error message on error
+    """
+    try:
+        since, until = analytics.hour_range(since, until)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        rows = await db.fetchall(q.GET_HOURLY_ROLLUP, (since, until), readonly=True)
+        return FastJSONResponse([analytics.hour_to_json(row) for row in rows])
+    except Exception as e:
+        log.exception("Error: %s", e)
         return {'error': 'Internal Server Error'}, 500
-    finally:
-        pool.release_connection(connection)
 
 
 def sanitize(incoming):
@@ -662,5 +1320,8 @@ def sanitize(incoming):
 #     goodstring = sanitize(badstring)
 #     return HTMLResponse(content=goodstring, status_code=200)
 
+startup.mark_ready()
+
 if __name__ == "__main__":
+  import uvicorn
   uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
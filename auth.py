@@ -0,0 +1,144 @@
+"""
+Password hashing and token verification, kept off the event loop.
+
+bcrypt costs around 100-250ms of CPU per hash or verify. Those run in a small process pool, so they neither block
+the event loop nor hold the GIL the request threads need. Where processes can't be started (AWS Lambda, which Vercel
+runs on, has no /dev/shm for their semaphores) or with HASH_EXECUTOR=thread, they run on threads instead; bcrypt
+releases the GIL while it works, so that still keeps the event loop free. At most HASH_WORKERS * HASH_QUEUE of them
+are admitted at once; past that a caller waits up to HASH_WAIT seconds for a slot and then gets Overloaded, so a burst
+far beyond what the workers can get through is turned away instead of queueing behind itself while every other route
+starves.
+
+Verified tokens are kept in a small LRU, so routes called with the same token over and over skip decoding it again.
+"""
+import asyncio
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import bcrypt
+
+# process or thread. Vercel sets VERCEL=1 on its deployments
+HASH_EXECUTOR = os.getenv('HASH_EXECUTOR', 'thread' if os.getenv('VERCEL') else 'process')
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', max(2, os.cpu_count() or 1)))
+HASH_QUEUE = int(os.getenv('HASH_QUEUE', 16))
+HASH_WAIT = float(os.getenv('HASH_WAIT', 10))
+HASH_ROUNDS = int(os.getenv('HASH_ROUNDS', 12))
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_TTL = float(os.getenv('TOKEN_CACHE_TTL', 300))
+
+log = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """
+    Raised when no hashing slot frees up within HASH_WAIT seconds.
+    """
+
+
+def is_hashed(stored):
+    return stored.startswith(("$2a$", "$2b$", "$2y$"))
+
+
+# These run in the worker processes, so they have to be plain module level functions
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+
+
+def _verify(password, hashed):
+    return bcrypt.checkpw(password.encode(), hashed.encode())
+
+
+class Hasher:
+    """
+    Bounded process (or thread) pool for bcrypt. The pool is started on first use, so importing the app stays cheap.
+    """
+    def __init__(self, workers=HASH_WORKERS, queue=HASH_QUEUE, wait=HASH_WAIT, executor=HASH_EXECUTOR):
+        self.workers = workers
+        self.wait = wait
+        self.executor = executor
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = asyncio.Semaphore(workers * queue)
+        self.rejected = 0
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = self._start()
+        return self._executor
+
+    def _start(self):
+        if self.executor == 'process':
+            try:
+                return ProcessPoolExecutor(max_workers=self.workers)
+            except (OSError, NotImplementedError, ImportError) as e:
+                log.warning("Can't start hashing processes, hashing on threads instead: %s", e)
+                self.executor = 'thread'
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hash")
+
+    async def _run(self, fn, *args):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.wait)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Overloaded()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool(), fn, *args)
+        finally:
+            self._slots.release()
+
+    async def hash(self, password):
+        return await self._run(_hash, password, HASH_ROUNDS)
+
+    async def verify(self, password, stored):
+        """
+        Checks password against the stored value. Rows created before hashing hold the plaintext password, those are
+        compared directly (in constant time) so the caller can rehash them.
+        """
+        if not is_hashed(stored):
+            return hmac.compare_digest(password.encode(), stored.encode())
+        return await self._run(_verify, password, stored)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class TokenCache:
+    """
+    LRU of decoded token payloads. Entries live for at most ttl seconds and never past the token's own expires_at.
+    """
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        entry = self._entries.get(token)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._entries[token]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, token, payload, expires_in=None):
+        lifetime = self.ttl if expires_in is None else min(self.ttl, expires_in)
+        if lifetime <= 0:
+            return
+        self._entries[token] = (payload, time.monotonic() + lifetime)
+        self._entries.move_to_end(token)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
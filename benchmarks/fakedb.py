@@ -0,0 +1,458 @@
+"""
+In-memory stand-in for the Postgres database, for benchmarking the API without a server.
+
+FakeConnection looks enough like a psycopg2 connection for pool.ConnectionPool, db.py, prepared.py and orders.py to
+run unchanged on top of it. Every statement sleeps for the configured latency on the calling thread, the way a
+round trip to Postgres blocks a database worker thread, and answers from a small seeded data set. Rows come back as
+namedtuples, like rows.Cursor.
+
+Statements are recognised by the queries.py constant they came from, including their prepared EXECUTE forms and the
+pagination.py list pages. An unknown statement raises, so a new query without a fake here fails the benchmark
+instead of quietly measuring nothing.
+"""
+import functools
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from psycopg2 import extensions
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import queries as q
+
+TABLE_COLUMNS = ("order_id", "max_customer", "table_id", "table_available")
+USER_COLUMNS = ("user_id", "user_name", "password", "isadmin")
+CUSTOMER_COLUMNS = ("customer_name", "customer_address", "customer_phone", "customer_email", "customer_id")
+ORDER_COLUMNS = ("customer_id", "table_id", "order_date", "order_status", "employee_id", "guest_amount", "order_id")
+ITEM_COLUMNS = ("food_id", "order_id", "quantity")
+
+# Tables the pagination.py list pages read, with their columns
+TABLES = {
+    "public.table": TABLE_COLUMNS,
+    "public.user": USER_COLUMNS,
+    "public.customer": CUSTOMER_COLUMNS,
+    "public.order": ORDER_COLUMNS,
+}
+
+_LIST_PAGE = re.compile(r"SELECT (?P<columns>.+) FROM (?P<table>\S+)(?: WHERE (?P<key>\w+) > %s)? ORDER BY \w+ LIMIT %s;")
+_EXECUTE = re.compile(r"EXECUTE (\w+)")
+
+# Prepared statement name -> queries.py constant name, as prepared.Registry names them
+_STATEMENTS = {f"q_{name.lower()}": name for name, value in vars(q).items() if name.isupper() and isinstance(value, str)}
+_BY_SQL = {value: name for name, value in vars(q).items() if name.isupper() and isinstance(value, str)}
+
+
+@functools.lru_cache(maxsize=None)
+def record_type(columns):
+    return namedtuple("Record", columns)
+
+
+class FakeDatabase:
+    """
+    Seeded data shared by every FakeConnection. Writes go through a lock, like row locks would serialise them.
+        latency: seconds each statement takes
+        jitter: extra random seconds, up to this much, per statement
+    """
+    def __init__(self, tables=40, customers=2000, users=50, orders=5000, items_per_order=3, latency=0.001, jitter=0.0,
+                 seed=0):
+        rng = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.statements = 0
+
+        self.tables = {table_id: [None, rng.choice((2, 4, 4, 6, 8)), table_id, True] for table_id in range(1, tables + 1)}
+        self.users = {user_id: [user_id, f"user{user_id}", "password", user_id == 1] for user_id in range(1, users + 1)}
+        self.customers = {
+            customer_id: [f"Customer {customer_id}", f"{customer_id} Main St", f"555-{customer_id:04d}",
+                          f"customer{customer_id}@example.com", customer_id]
+            for customer_id in range(1, customers + 1)
+        }
+        self.orders = {
+            order_id: [rng.randint(1, customers), rng.randint(1, tables), None, None, None, None, order_id]
+            for order_id in range(1, orders + 1)
+        }
+        self.items = {
+            order_id: [[rng.randint(1, 200), order_id, rng.randint(1, 4)] for _ in range(items_per_order)]
+            for order_id in self.orders
+        }
+        self.next_order_id = orders + 1
+        self.next_booking_id = 1
+        # Analytics rollups, as the startup backfill would leave them
+        self.table_rollup = {}
+        self.food_rollup = {}
+        self.hourly_rollup = {}
+        self.add_to_rollups(self.orders, datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0))
+
+    def add_to_rollups(self, order_ids, hour):
+        for order_id in order_ids:
+            table_id = self.orders[order_id][1]
+            items = self.items.get(order_id, ())
+            quantity = sum(item[2] for item in items)
+            if table_id is not None:
+                rollup = self.table_rollup.setdefault(table_id, [0, 0, 0])
+                rollup[0] += 1
+                rollup[1] += 1
+                rollup[2] += quantity
+            for item in items:
+                rollup = self.food_rollup.setdefault(item[0], [0, 0])
+                rollup[0] += item[2]
+                rollup[1] += 1
+            rollup = self.hourly_rollup.setdefault(hour, [0, 0])
+            rollup[0] += 1
+            rollup[1] += quantity
+
+    def pause(self):
+        delay = self.latency + (random.random() * self.jitter if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class FakeInfo:
+    def __init__(self):
+        self.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection:
+    encoding = "UTF8"
+
+    def __init__(self, database):
+        self.database = database
+        self.closed = 0
+        self.info = FakeInfo()
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.database.pause()
+        self.info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.database = connection.database
+        self._rows = []
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._rows = []
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def mogrify(self, template, args):
+        # Only used by execute_values, whose statements the fake doesn't inspect
+        return template
+
+    def execute(self, query, params=None):
+        database = self.database
+        database.pause()
+        database.statements += 1
+        self.connection.info.transaction_status = extensions.TRANSACTION_STATUS_INTRANS
+        columns, rows = self._run(query, params or ())
+        self.description = [(column, ) for column in columns] if columns else None
+        Record = record_type(tuple(columns)) if columns else None
+        self._rows = [Record(*row) for row in rows] if Record else []
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def _run(self, query, params):
+        if isinstance(query, bytes):
+            # execute_values pages: the order and order item inserts of /orders/place
+            return (), []
+        head = query.lstrip().split(None, 1)[0].upper()
+        if head in ("PREPARE", "SAVEPOINT", "RELEASE", "ROLLBACK") or query == "SELECT 1":
+            return (), []
+        if head == "EXECUTE":
+            name = _STATEMENTS.get(_EXECUTE.match(query.lstrip()).group(1))
+        else:
+            name = _BY_SQL.get(query)
+        if name is None:
+            page = _LIST_PAGE.match(query)
+            if page is None:
+                raise NotImplementedError(f"fakedb has no answer for: {query[:80]}")
+            return self._list_page(page, params)
+        handler = getattr(self, f"_{name.lower()}", None)
+        if handler is None:
+            raise NotImplementedError(f"fakedb has no answer for {name}")
+        with self.database.lock:
+            return handler(*params)
+
+    def _list_page(self, page, params):
+        table = page.group("table")
+        source = {
+            "public.table": self.database.tables,
+            "public.user": self.database.users,
+            "public.customer": self.database.customers,
+            "public.order": self.database.orders,
+        }[table]
+        columns = [column.strip() for column in page.group("columns").split(",")]
+        all_columns = TABLES[table]
+        positions = [all_columns.index(column) for column in columns]
+        after, limit = params if page.group("key") else (None, params[0])
+        keys = sorted(key for key in source if after is None or key > after)
+        if limit is not None:
+            keys = keys[:limit]
+        return columns, [[source[key][position] for position in positions] for key in keys]
+
+    # Tables
+
+    def _get_table_info(self):
+        return TABLE_COLUMNS, [list(row) for _, row in sorted(self.database.tables.items())]
+
+    def _select_reservation(self, table_id):
+        row = self.database.tables.get(table_id)
+        return TABLE_COLUMNS, [list(row)] if row else []
+
+    def _select_reservations(self, table_ids):
+        return TABLE_COLUMNS, [list(self.database.tables[table_id]) for table_id in table_ids if table_id in self.database.tables]
+
+    def _set_reservation(self, table_id):
+        if table_id in self.database.tables:
+            self.database.tables[table_id][3] = False
+        return (), []
+
+    def _clear_reservation(self, table_id):
+        if table_id in self.database.tables:
+            self.database.tables[table_id][3] = True
+        return (), []
+
+    def _clear_all_reservations(self):
+        for row in self.database.tables.values():
+            row[3] = True
+        return (), []
+
+    def _allocate_table(self, party_size, candidates, expires_at):
+        for table_id in candidates:
+            row = self.database.tables.get(table_id)
+            if row and row[3] and row[1] >= party_size:
+                row[3] = False
+                return ("table_id", ), [[table_id]]
+        return ("table_id", ), []
+
+    def _set_table_expiry(self, table_id, expires_at):
+        return (), []
+
+    def _clear_table_expiry(self, table_id):
+        return (), []
+
+    def _clear_all_table_expiries(self):
+        return (), []
+
+    def _get_table_expiries(self):
+        return ("table_id", "expires_at"), []
+
+    def _take_due_table_expiry(self, table_id, deadline):
+        return ("table_id", ), []
+
+    # Bookings
+
+    def _create_booking(self, table_id, customer_id, party_size, start, end):
+        booking_id = self.database.next_booking_id
+        self.database.next_booking_id += 1
+        return ("booking_id", ), [[booking_id]]
+
+    def _cancel_booking(self, booking_id):
+        return ("booking_id", ), [[booking_id]]
+
+    def _get_upcoming_bookings(self):
+        return ("booking_id", "table_id", "lower", "upper"), []
+
+    # Coordination
+
+    def _notify_event(self, channel, payload):
+        return ("pg_notify", ), [[None]]
+
+    # Users
+
+    def _get_all_users(self):
+        return USER_COLUMNS, [list(row) for _, row in sorted(self.database.users.items())]
+
+    def _get_user_by_username(self, user_name):
+        return USER_COLUMNS, [list(row) for row in self.database.users.values() if row[1] == user_name]
+
+    def _create_new_user(self, user_id, user_name, password, isadmin):
+        self.database.users[user_id] = [user_id, user_name, password, isadmin]
+        return (), []
+
+    def _update_user_password(self, password, user_id):
+        if user_id in self.database.users:
+            self.database.users[user_id][2] = password
+        return (), []
+
+    # Customers
+
+    def _get_all_customers(self):
+        return CUSTOMER_COLUMNS, [list(row) for _, row in sorted(self.database.customers.items())]
+
+    def _get_customers_by_ids(self, customer_ids):
+        return CUSTOMER_COLUMNS, [list(self.database.customers[customer_id]) for customer_id in customer_ids
+                                  if customer_id in self.database.customers]
+
+    def _get_customer_ids_by_emails(self, emails):
+        wanted = set(emails)
+        return ("customer_id", "customer_email"), [[row[4], row[3]] for row in self.database.customers.values()
+                                                   if row[3] in wanted]
+
+    def _create_new_customer(self, name, address, phone, email):
+        customer_id = max(self.database.customers) + 1
+        self.database.customers[customer_id] = [name, address, phone, email, customer_id]
+        return (), []
+
+    # Schema, every relation migrate.py creates is there
+
+    def _get_missing_relations(self, names):
+        return ("name", ), []
+
+    # Customer search
+
+    def _search_customers(self, term, *params):
+        # Prefix matches score 1 and substring matches stand in for trigram similarity
+        prefix, phone, limit = params[1][:-1].replace("\\", ""), params[3], params[-1]
+        phone = phone[:-1] if phone else None
+        found = []
+        for row in self.database.customers.values():
+            name, email, digits = row[0].lower(), row[3].lower(), re.sub(r"\D", "", row[2])
+            if name.startswith(prefix) or email.startswith(prefix) or (phone and digits.startswith(phone)):
+                score = 1.0
+            elif term in name or term in email:
+                score = 0.6
+            else:
+                continue
+            found.append((-score, row[4], list(row) + [score]))
+        found.sort()
+        return CUSTOMER_COLUMNS + ("score", ), [row for _, _, row in found[:limit]]
+
+    def _get_frequent_customers(self, limit):
+        counts = {}
+        for order in self.database.orders.values():
+            counts[order[0]] = counts.get(order[0], 0) + 1
+        top = sorted(counts, key=lambda customer_id: -counts[customer_id])[:limit]
+        return CUSTOMER_COLUMNS, [list(self.database.customers[customer_id]) for customer_id in top
+                                  if customer_id in self.database.customers]
+
+    # Orders
+
+    def _get_all_orders(self):
+        return ORDER_COLUMNS, [list(row) for _, row in sorted(self.database.orders.items())]
+
+    def _get_all_order_items(self):
+        return ITEM_COLUMNS, [list(item) for items in self.database.items.values() for item in items]
+
+    def _get_orders_by_ids(self, order_ids):
+        return ORDER_COLUMNS, [list(self.database.orders[order_id]) for order_id in order_ids if order_id in self.database.orders]
+
+    def _get_order_items_by_ids(self, order_ids):
+        return ITEM_COLUMNS, [list(item) for order_id in order_ids for item in self.database.items.get(order_id, ())]
+
+    def _export_all_orders(self):
+        rows = []
+        for order_id, row in sorted(self.database.orders.items()):
+            items = [{"food_id": item[0], "quantity": item[2]} for item in self.database.items.get(order_id, ())]
+            rows.append(list(row) + [items])
+        return ORDER_COLUMNS + ("items", ), rows
+
+    def _create_order(self, customer_id, table_id):
+        order_id = self.database.next_order_id
+        self.database.next_order_id += 1
+        self.database.orders[order_id] = [customer_id, table_id, None, None, None, None, order_id]
+        return ("order_id", ), [[order_id]]
+
+    def _reserve_order_ids(self, count):
+        start = self.database.next_order_id
+        self.database.next_order_id += count
+        return ("nextval", ), [[order_id] for order_id in range(start, start + count)]
+
+    def _clear_order(self, order_id):
+        row = self.database.orders.get(order_id)
+        if row is None or row[1] is None:
+            return ("table_id", ), []
+        table_id, row[1] = row[1], None
+        return ("table_id", ), [[table_id]]
+
+    def _clear_all_orders(self):
+        for row in self.database.orders.values():
+            row[1] = None
+        return (), []
+
+    # Analytics
+
+    def _add_orders_to_rollups(self, shards, order_ids):
+        self.database.add_to_rollups([order_id for order_id in order_ids if order_id in self.database.orders],
+                                     datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0))
+        return (), []
+
+    def _close_table_rollup(self, table_id):
+        rollup = self.database.table_rollup.get(table_id)
+        if rollup and rollup[1] > 0:
+            rollup[1] -= 1
+        return (), []
+
+    def _close_all_table_rollups(self):
+        for rollup in self.database.table_rollup.values():
+            rollup[1] = 0
+        return (), []
+
+    def _get_table_rollup(self):
+        return ("table_id", "orders", "open_orders", "items"), [[table_id] + rollup for table_id, rollup
+                                                               in sorted(self.database.table_rollup.items())]
+
+    def _get_food_rollup(self, limit):
+        ranked = sorted(self.database.food_rollup.items(), key=lambda entry: (-entry[1][0], entry[0]))[:limit]
+        return ("food_id", "quantity", "orders"), [[food_id] + rollup for food_id, rollup in ranked]
+
+    def _get_hourly_rollup(self, since, until):
+        return ("hour", "orders", "items"), [[hour] + rollup for hour, rollup in sorted(self.database.hourly_rollup.items())
+                                             if since <= hour < until]
+
+    # Idempotency keys, every key is new
+
+    def _purge_idempotency_keys(self, ttl):
+        return (), []
+
+    def _claim_idempotency_key(self, scope, key, request_hash, ttl):
+        return ("key", ), [[key]]
+
+    def _save_idempotent_response(self, response, scope, key):
+        return (), []
+
+    def _get_idempotent_response(self, scope, key):
+        return ("request_hash", "response"), []
+
+    # Replica
+
+    def _replica_lag(self):
+        return ("case", ), [[0]]
+
@@ -0,0 +1,349 @@
+"""
+Load test for the API without a database or a server.
+
+The app runs in-process on top of benchmarks/fakedb.py: the real pool, db.py, prepared statements and routes, with
+every statement answered from memory after a configurable latency. Each route is driven through the ASGI interface
+by a number of concurrent clients, one route at a time, and reported with its latency percentiles, requests per
+second and the time requests spent waiting for a pooled connection.
+
+Baselines: --save-baseline writes the results to a JSON file, --baseline compares a run against one and exits
+non-zero when a route's p95 latency or throughput is worse by more than --tolerance, or when any request fails.
+Compare runs made on the same machine with the same settings. benchmarks/baseline.json is a run at the defaults;
+save a fresh one on your own machine before comparing against it.
+
+Every HTTP route has a scenario. The WebSocket and Server-Sent Events streams are long-lived and aren't driven.
+
+Usage:
+    python benchmarks/load.py [--requests 500] [--concurrency 20] [--latency-ms 1] [--only orders]
+    python benchmarks/load.py --save-baseline benchmarks/baseline.json
+    python benchmarks/load.py --baseline benchmarks/baseline.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Settings the app reads at import. A real .env can't override these, load_dotenv never replaces what is set
+os.environ.update({
+    'POSTGRES_REPLICA_HOST': '',
+    'POSTGRES_POOL_LAZY': '1',
+    'SECRET_KEY': 'benchmark',
+    'ALGORITHM': 'HS256',
+    'LOG_LEVEL': 'WARNING',
+    'LOG_FILE': '',
+    # One process, and the fake database has no LISTEN connection
+    'COORDINATE_WORKERS': '0',
+    # Measure the routes, not the load shedding in front of them
+    'ADMISSION_CONCURRENCY': '100000',
+    'ADMISSION_SHED_WAIT': '3600',
+    # The cheapest bcrypt cost and room for every client, so /login measures the route rather than the hashing
+    'HASH_ROUNDS': '4',
+    'HASH_EXECUTOR': 'thread',
+    'HASH_QUEUE': '1000',
+    'HASH_WAIT': '60',
+})
+
+from fakedb import FakeDatabase
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def histogram_delta(histogram, before):
+    """
+    Count, sum and approximate p95 of what histogram observed since before = (counts, sum).
+    """
+    counts = [now - then for now, then in zip(histogram.counts, before[0])]
+    total = sum(counts)
+    p95 = 0.0
+    if total:
+        running = 0
+        for bound, count in zip(histogram.buckets + (float("inf"), ), counts):
+            running += count
+            if running >= 0.95 * total:
+                p95 = bound
+                break
+    return total, histogram.sum - before[1], p95
+
+
+async def call(app, method, path, body=None, headers=None):
+    """
+    Sends one request straight into the ASGI app. Returns (status, body bytes).
+    """
+    path, _, query = path.partition("?")
+    raw_headers = [(b"host", b"benchmark")]
+    raw_headers += [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()]
+    payload = b""
+    if body is not None:
+        payload = json.dumps(body, default=str).encode()
+        raw_headers += [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())]
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": raw_headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("benchmark", 80),
+    }
+    finished = asyncio.Event()
+    request_sent = False
+    status = None
+    chunks = []
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                finished.set()
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        finished.set()
+    return status, b"".join(chunks)
+
+
+"""
+Scenarios. Each takes (rng, state) and returns (method, path, body, headers)
+"""
+
+_slots = itertools.count(1)
+_new_users = itertools.count(100000)
+
+
+def _order(rng, state):
+    return {"table_number": rng.randint(1, state.tables), "customer_id": rng.randint(1, state.customers),
+            "items": [{"food_id": rng.randint(1, 200), "quantity": rng.randint(1, 4)} for _ in range(3)]}
+
+
+def _booking(rng, state):
+    # Every booking gets its own future hour, so none of them conflict
+    start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) + timedelta(hours=next(_slots))
+    return {"table_id": rng.randint(1, state.tables), "party_size": 2, "start": start.isoformat(),
+            "end": (start + timedelta(hours=1)).isoformat()}
+
+
+def _user(user_id):
+    return {"user_id": user_id, "user_name": f"new{user_id}", "password": "password", "isadmin": False}
+
+
+def _customer(rng):
+    number = rng.randint(1, 10 ** 6)
+    return {"customer_name": f"New Customer {number}", "customer_address": f"{number} High St",
+            "customer_phone": f"555-{number:06d}", "customer_email": f"new{number}@example.com"}
+
+
+def _available(rng, state):
+    start = datetime.now(timezone.utc) + timedelta(days=rng.randint(1, 30))
+    end = start + timedelta(hours=2)
+    return f"/booking/available?party_size=4&start={start.strftime('%Y-%m-%dT%H:%M:%S')}&end={end.strftime('%Y-%m-%dT%H:%M:%S')}"
+
+
+SCENARIOS = {
+    "GET /": lambda rng, s: ("GET", "/", None, None),
+    "GET /startup": lambda rng, s: ("GET", "/startup", None, None),
+    "GET /table": lambda rng, s: ("GET", "/table", None, None),
+    "GET /table?limit": lambda rng, s: ("GET", "/table?limit=10&fields=table_id,table_available", None, None),
+    "GET /table/{n}": lambda rng, s: ("GET", f"/table/{rng.randint(1, s.tables)}", None, None),
+    "POST /table/set/{n}": lambda rng, s: ("POST", f"/table/set/{rng.randint(1, s.tables)}", None,
+                                           {"Idempotency-Key": uuid.uuid4().hex}),
+    "POST /table/clear/{n}": lambda rng, s: ("POST", f"/table/clear/{rng.randint(1, s.tables)}", None, None),
+    "POST /table/clear_all/": lambda rng, s: ("POST", "/table/clear_all/", None, None),
+    "POST /table/allocate/{n}": lambda rng, s: ("POST", f"/table/allocate/{rng.randint(1, 6)}", None, None),
+    "GET /booking/available": lambda rng, s: ("GET", _available(rng, s), None, None),
+    "POST /booking/set": lambda rng, s: ("POST", "/booking/set", _booking(rng, s), None),
+    "POST /booking/{id}/clear": lambda rng, s: ("POST", f"/booking/{rng.randint(1, 1000)}/clear", None, None),
+    "POST /login": lambda rng, s: ("POST", "/login", {"username": f"user{rng.randint(1, s.users)}", "password": "password"}, None),
+    "GET /user/me": lambda rng, s: ("GET", "/user/me", None, {"Authorization": f"Bearer {s.token}"}),
+    "GET /user/username/{name}": lambda rng, s: ("GET", f"/user/username/user{rng.randint(1, 2 * s.users)}", None, None),
+    "GET /users": lambda rng, s: ("GET", "/users", None, None),
+    "GET /users?limit": lambda rng, s: ("GET", "/users?limit=20&fields=user_id,user_name", None, None),
+    "POST /users/create": lambda rng, s: ("POST", "/users/create", _user(next(_new_users)), None),
+    "GET /customer": lambda rng, s: ("GET", "/customer", None, None),
+    "GET /customer?limit": lambda rng, s: ("GET", "/customer?limit=50", None, None),
+    "GET /customer/search": lambda rng, s: ("GET", f"/customer/search?q=customer {rng.randint(1, 200)}", None, None),
+    "POST /customer/set": lambda rng, s: ("POST", "/customer/set", _customer(rng), None),
+    "GET /customer/{id}": lambda rng, s: ("GET", f"/customer/{rng.randint(1, s.customers)}", None, None),
+    "GET /customer/id/{email}": lambda rng, s: ("GET", f"/customer/id/customer{rng.randint(1, s.customers)}@example.com", None, None),
+    "GET /orders": lambda rng, s: ("GET", "/orders", None, None),
+    "GET /orders?limit": lambda rng, s: ("GET", "/orders?limit=50", None, None),
+    "GET /orders?format=ndjson": lambda rng, s: ("GET", "/orders?format=ndjson", None, None),
+    "GET /order/{id}": lambda rng, s: ("GET", f"/order/{rng.randint(1, s.orders)}", None, None),
+    "POST /order/place": lambda rng, s: ("POST", "/order/place", _order(rng, s), {"Idempotency-Key": uuid.uuid4().hex}),
+    "POST /orders/place": lambda rng, s: ("POST", "/orders/place", [_order(rng, s) for _ in range(10)], None),
+    "POST /order/{id}/clear": lambda rng, s: ("POST", f"/order/{rng.randint(1, s.orders)}/clear", None, None),
+    "POST /orders/clear": lambda rng, s: ("POST", "/orders/clear", None, None),
+    "GET /analytics/tables": lambda rng, s: ("GET", "/analytics/tables", None, None),
+    "GET /analytics/foods": lambda rng, s: ("GET", "/analytics/foods?limit=20", None, None),
+    "GET /analytics/hourly": lambda rng, s: ("GET", "/analytics/hourly", None, None),
+    "GET /metrics": lambda rng, s: ("GET", "/metrics", None, None),
+}
+
+# Statuses that count as success besides 200. Allocation answers 409 once every table that fits is taken
+EXPECTED = {
+    "POST /table/allocate/{n}": {200, 409},
+}
+
+
+class State:
+    def __init__(self, database):
+        self.tables = len(database.tables)
+        self.customers = len(database.customers)
+        self.users = len(database.users)
+        self.orders = len(database.orders)
+        self.token = None
+
+
+def failed(name, status, body):
+    # Routes report unexpected errors as a 200 with an error tuple body
+    return status not in EXPECTED.get(name, {200}) or body.startswith(b'[{"error"')
+
+
+async def run_scenario(app, pool, name, make, state, requests, concurrency, warmup, seed):
+    rng = random.Random(seed)
+    for _ in range(warmup):
+        await call(app, *make(rng, state))
+
+    primary = pool.get_pool()
+    before = (list(primary.wait_time.counts), primary.wait_time.sum)
+    latencies = []
+    errors = []
+    remaining = itertools.count()
+
+    async def client():
+        while next(remaining) < requests:
+            method, path, body, headers = make(rng, state)
+            started = time.perf_counter()
+            status, content = await call(app, method, path, body, headers)
+            latencies.append(time.perf_counter() - started)
+            if failed(name, status, content):
+                errors.append((status, content[:200]))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    waits, wait_sum, wait_p95 = histogram_delta(primary.wait_time, before)
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "pool_wait_mean_ms": (wait_sum / waits) * 1000 if waits else 0.0,
+        "pool_wait_p95_ms": wait_p95 * 1000,
+        "first_error": errors[0] if errors else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of human readable regressions.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']:.2f}ms, baseline {base['p95_ms']:.2f}ms")
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['rps']:.0f} req/s, baseline {base['rps']:.0f} req/s")
+    return regressions
+
+
+async def main(args):
+    import pool
+    database = FakeDatabase(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, seed=args.seed)
+    pool.ConnectionPool._connect = lambda self: database.connect()
+
+    import app as application
+    app = application.app
+    await app.router.startup()
+
+    state = State(database)
+    status, content = await call(app, "POST", "/login", {"username": "user1", "password": "password"})
+    state.token = json.loads(content)["token"] if status == 200 else None
+
+    pattern = re.compile(args.only) if args.only else None
+    results = {}
+    print(f"{'route':<28} {'req':>6} {'err':>4} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'wait ms':>8} {'wait p95':>8}")
+    try:
+        for index, (name, make) in enumerate(SCENARIOS.items()):
+            if pattern and not pattern.search(name):
+                continue
+            result = await run_scenario(app, pool, name, make, state, args.requests, args.concurrency, args.warmup,
+                                        args.seed + index)
+            results[name] = result
+            print(f"{name:<28} {result['requests']:>6} {result['errors']:>4} {result['rps']:>8.0f} "
+                  f"{result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+                  f"{result['pool_wait_mean_ms']:>8.2f} {result['pool_wait_p95_ms']:>8.2f}")
+    finally:
+        await app.router.shutdown()
+    print(f"{database.statements} statements answered by the fake database")
+
+    failures = [f"{name}: {result['errors']} failed requests, first: {result['first_error']}"
+                for name, result in results.items() if result["errors"]]
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump({name: {key: value for key, value in result.items() if key != "first_error"}
+                       for name, result in results.items()}, file, indent=2, sort_keys=True)
+        print(f"baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            failures += compare(results, json.load(file), args.tolerance)
+
+    if failures:
+        print("\nFAILED")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500, help="measured requests per route")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent clients per route")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests per route first")
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="time each statement takes")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="random extra time per statement, up to this")
+    parser.add_argument("--only", help="regex, only run routes whose name matches")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="JSON file from --save-baseline to compare against")
+    parser.add_argument("--save-baseline", help="write this run's results here")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,102 @@
+"""
+Benchmarks the GET /orders assembly step on synthetic rows, without a database.
+
+Compares the grouped assembly in orders.py against the old approach of rescanning every order item for every order.
+The old approach is quadratic, so it is only timed on small inputs and the ratio between sizes is reported.
+
+Usage:
+    python benchmarks/orders_bench.py [--orders 100000] [--items-per-order 3]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orders as o
+
+# Shaped like the rows rows.Cursor returns for public.order and public.order_items
+OrderRow = namedtuple("OrderRow", "customer_id table_id order_date order_status employee_id guest_amount order_id")
+ItemRow = namedtuple("ItemRow", "food_id order_id quantity")
+
+
+def make_rows(order_count, items_per_order, seed=0):
+    """
+    Builds rows shaped like public.order (order_id in column 6) and public.order_items (food_id, order_id, quantity).
+    Items are shuffled so they aren't conveniently grouped already.
+    """
+    rng = random.Random(seed)
+    order_rows = [OrderRow(rng.randint(1, 5000), rng.randint(1, 40), None, None, None, None, order_id)
+                  for order_id in range(1, order_count + 1)]
+    item_rows = [ItemRow(rng.randint(1, 200), order_id, rng.randint(1, 4))
+                 for order_id in range(1, order_count + 1)
+                 for _ in range(items_per_order)]
+    rng.shuffle(item_rows)
+    return order_rows, item_rows
+
+
+def legacy_assemble(orders, order_items):
+    # The pre-grouping implementation of GET /orders
+    return [
+        {
+            "order_id": row[6],
+            "table_number": row[1],
+            "customer_id": row[0],
+            "items": [
+                {
+                    "food_id": order_item[0],
+                    "quantity": order_item[2]
+                }
+
+                for order_item in order_items
+                if order_item[1] == row[6]
+            ]
+        }
+
+        for row in orders
+    ]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=100_000)
+    parser.add_argument("--items-per-order", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'implementation':<10} {'orders':>8} {'items':>8} {'seconds':>10}")
+
+    grouped_sizes = sorted({args.orders // 10, args.orders // 2, args.orders})
+    for size in grouped_sizes:
+        order_rows, item_rows = make_rows(size, args.items_per_order)
+        seconds, result = timed(o.assemble_orders, order_rows, item_rows)
+        assert sum(len(order["items"]) for order in result) == len(item_rows)
+        print(f"{'grouped':<10} {size:>8} {len(item_rows):>8} {seconds:>10.4f}")
+
+    # Check both implementations agree before timing the old one
+    order_rows, item_rows = make_rows(500, args.items_per_order)
+    assert o.assemble_orders(order_rows, item_rows) == legacy_assemble(order_rows, item_rows)
+
+    legacy_times = []
+    for size in (1000, 2000, 4000):
+        order_rows, item_rows = make_rows(size, args.items_per_order)
+        seconds, _ = timed(legacy_assemble, order_rows, item_rows)
+        legacy_times.append(seconds)
+        print(f"{'legacy':<10} {size:>8} {len(item_rows):>8} {seconds:>10.4f}")
+
+    # Each doubling should roughly quadruple the legacy time
+    growth = legacy_times[-1] / legacy_times[-2]
+    estimate = legacy_times[-1] * (args.orders / 4000) ** 2
+    print(f"legacy growth per doubling: {growth:.1f}x, estimated at {args.orders} orders: {estimate:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
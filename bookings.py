@@ -0,0 +1,169 @@
+"""
+Future time-slot bookings. public.booking is the source of truth: its exclusion constraint stops two bookings of the
+same table from overlapping. This module keeps an in-memory copy of the upcoming bookings to answer "which tables
+are free from 19:00 to 20:30" without scanning every booking.
+
+Because a table's bookings never overlap, sorting them by start also sorts them by end. One binary search per table
+then finds the only booking that could clash with a requested slot.
+
+The index is read from the database on the first booking request rather than at startup, so a worker that never
+serves one never loads it.
+"""
+import asyncio
+import bisect
+from datetime import datetime, timezone
+
+
+def aware(moment):
+    """
+    Treats naive datetimes as UTC so they compare with the timestamptz values read from Postgres.
+    """
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+class _TableBookings:
+    """
+    One table's bookings as parallel lists sorted by start time.
+    """
+    __slots__ = ("starts", "ends", "ids")
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.ids = []
+
+    def add(self, booking_id, start, end):
+        position = bisect.bisect_left(self.starts, start)
+        self.starts.insert(position, start)
+        self.ends.insert(position, end)
+        self.ids.insert(position, booking_id)
+
+    def remove(self, booking_id, start):
+        position = bisect.bisect_left(self.starts, start)
+        while position < len(self.ids) and self.starts[position] == start:
+            if self.ids[position] == booking_id:
+                del self.starts[position], self.ends[position], self.ids[position]
+                return
+            position += 1
+
+    def is_free(self, start, end):
+        # The first booking ending after start is the only one that can overlap [start, end)
+        position = bisect.bisect_right(self.ends, start)
+        return position == len(self.starts) or self.starts[position] >= end
+
+    def prune(self, now):
+        cut = bisect.bisect_right(self.ends, now)
+        if cut:
+            del self.starts[:cut], self.ends[:cut], self.ids[:cut]
+
+
+class BookingIndex:
+    """
+    Upcoming bookings grouped by table.
+    """
+    def __init__(self):
+        self._tables = {}
+        self._bookings = {}
+        self.loaded = False
+        self._loading = None
+        self._journal = None
+
+    def __len__(self):
+        return len(self._bookings)
+
+    async def ensure_loaded(self, fetch_rows):
+        """
+        Loads the index the first time it is needed. Concurrent callers share one query.
+            fetch_rows: coroutine function returning (booking_id, table_id, start, end) rows (GET_UPCOMING_BOOKINGS)
+        """
+        while not self.loaded:
+            if self._loading is None:
+                self._loading = asyncio.ensure_future(self._load(fetch_rows))
+            await asyncio.shield(self._loading)
+
+    def invalidate(self):
+        """
+        Marks the index out of date, e.g. after change events may have been missed. The next request reloads it.
+        """
+        self.loaded = False
+        self._loading = None
+
+    async def _load(self, fetch_rows):
+        # Changes that commit while the rows are read may or may not be in them, so they are kept and replayed on top
+        journal = self._journal = []
+        try:
+            rows = await fetch_rows()
+        except BaseException:
+            if self._loading is asyncio.current_task():
+                self._loading = None
+            raise
+        finally:
+            if self._journal is journal:
+                self._journal = None
+        # Invalidated while the rows were read, a newer load replaces them
+        if self._loading is not asyncio.current_task():
+            return
+        self.load(rows)
+        for change, args in journal:
+            change(*args)
+
+    def load(self, rows):
+        """
+        Rebuilds the index from (booking_id, table_id, start, end) rows (GET_UPCOMING_BOOKINGS).
+        """
+        self._tables = {}
+        self._bookings = {}
+        for booking_id, table_id, start, end in rows:
+            self._add(booking_id, table_id, start, end)
+        self.loaded = True
+
+    def add(self, booking_id, table_id, start, end):
+        if self.loaded:
+            self._add(booking_id, table_id, start, end)
+        elif self._journal is not None:
+            self._journal.append((self.add, (booking_id, table_id, start, end)))
+
+    def _add(self, booking_id, table_id, start, end):
+        # A replayed change may already be in the rows it is replayed on
+        self._remove(booking_id)
+        start, end = aware(start), aware(end)
+        self._tables.setdefault(table_id, _TableBookings()).add(booking_id, start, end)
+        self._bookings[booking_id] = (table_id, start)
+
+    def remove(self, booking_id):
+        if self.loaded:
+            self._remove(booking_id)
+        elif self._journal is not None:
+            self._journal.append((self.remove, (booking_id, )))
+
+    def _remove(self, booking_id):
+        booking = self._bookings.pop(booking_id, None)
+        if booking is not None:
+            table_id, start = booking
+            self._tables[table_id].remove(booking_id, start)
+
+    def prune(self, now=None):
+        """
+        Drops bookings that have already ended.
+        """
+        now = now or datetime.now(timezone.utc)
+        for table in self._tables.values():
+            for booking_id in table.ids[:bisect.bisect_right(table.ends, now)]:
+                del self._bookings[booking_id]
+            table.prune(now)
+
+    def is_free(self, table_id, start, end):
+        table = self._tables.get(table_id)
+        return table is None or table.is_free(aware(start), aware(end))
+
+    def free_tables(self, capacities, party_size, start, end):
+        """
+        Table ids that seat party_size and have nothing booked overlapping [start, end), smallest first.
+        Args:
+            capacities: dict of table_id -> max_customer
+        """
+        start, end = aware(start), aware(end)
+        fitting = sorted((capacity, table_id) for table_id, capacity in capacities.items() if capacity >= party_size)
+        return [table_id for _, table_id in fitting if self.is_free(table_id, start, end)]
@@ -0,0 +1,116 @@
+"""
+In-process read-through cache of public.table. GET /table and GET /table/{table_number} are polled constantly by the
+front end, so they are answered from here and only go to the database after a write invalidated what they need.
+
+Every entry carries a version that feeds the ETag, so a poller sending If-None-Match for unchanged state gets a 304
+without a query or a response body.
+"""
+import itertools
+import uuid
+
+from fastapi import Response
+
+# Versions restart at zero with the process, the boot id keeps ETags from one run matching another
+_boot = uuid.uuid4().hex[:8]
+
+
+def etag_matches(request, etag):
+    """
+    True when the request's If-None-Match header already names etag.
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (candidate.strip().removeprefix("W/") for candidate in header.split(","))
+
+
+def not_modified(etag):
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+class TableCache:
+    """
+    Caches rows of public.table keyed by table_id.
+        fetch_all: coroutine returning every row (GET_TABLE_INFO)
+        fetch_one: coroutine taking a table_id and returning its rows (SELECT_RESERVATION)
+        key: maps a row to its table_id
+        forget: called with a table_id on invalidation (None for every table), to stop reads that start after the
+        write from sharing a fetch_one lookup that was sent before it, e.g. Loader.clear
+    """
+    def __init__(self, fetch_all, fetch_one, key, forget=None):
+        self.fetch_all = fetch_all
+        self.fetch_one = fetch_one
+        self.key = key
+        self.forget = forget
+        self._rows = {}
+        self._versions = {}
+        self._complete = False
+        self._generation = 0
+        self._clock = itertools.count(1)
+
+    def _etag(self, name, version):
+        return f'"{_boot}-{name}-{version}"'
+
+    @property
+    def etag(self):
+        """
+        ETag of the full table list, or None when it has to be reloaded first.
+        """
+        return self._etag("all", self._generation) if self._complete else None
+
+    def table_etag(self, table_id):
+        if table_id not in self._rows:
+            return None
+        return self._etag(table_id, self._versions[table_id])
+
+    def invalidate(self, table_id):
+        """
+        Drops one table after a write to it. The full list is reloaded on its next read.
+        """
+        self._rows.pop(table_id, None)
+        self._versions[table_id] = next(self._clock)
+        self._complete = False
+        self._generation = next(self._clock)
+        if self.forget is not None:
+            self.forget(table_id)
+
+    def invalidate_all(self):
+        self._rows = {}
+        self._versions = {table_id: next(self._clock) for table_id in self._versions}
+        self._complete = False
+        self._generation = next(self._clock)
+        if self.forget is not None:
+            self.forget(None)
+
+    async def all(self):
+        """
+        Returns (rows, etag) for every table, in table_id order.
+        """
+        if not self._complete:
+            generation = self._generation
+            rows = await self.fetch_all()
+            # A write that landed while the query ran makes these rows stale, serve them but don't keep them
+            if generation != self._generation:
+                return rows, None
+            self._rows = {self.key(row): row for row in rows}
+            for table_id in self._rows:
+                self._versions.setdefault(table_id, 0)
+            self._complete = True
+        return [self._rows[table_id] for table_id in sorted(self._rows)], self.etag
+
+    async def one(self, table_id):
+        """
+        Returns (rows, etag) for a single table. rows is empty when the table doesn't exist.
+        """
+        if table_id not in self._rows:
+            version = self._versions.get(table_id, 0)
+            rows = await self.fetch_one(table_id)
+            if version != self._versions.get(table_id, 0):
+                return rows, None
+            if not rows:
+                return rows, None
+            self._rows[table_id] = rows[0]
+            self._versions[table_id] = version
+        return [self._rows[table_id]], self.table_etag(table_id)
@@ -0,0 +1,156 @@
+"""
+Coordination between uvicorn workers.
+
+Each worker keeps its own table cache, allocation index, booking index, expiry timers and live subscribers. With more
+than one worker, a change made through one of them has to reach the others. The worker that makes a change announces
+it with pg_notify inside the same transaction, so the event goes out exactly when the change commits and never for a
+write that rolled back. Every worker LISTENs on a dedicated connection outside the pool and applies the events other
+workers sent.
+
+Expiry timers need no owner: every worker schedules every reservation, and TAKE_DUE_TABLE_EXPIRY deletes the expiry
+row for exactly one of them, so one worker resets the table and announces it and the rest do nothing.
+
+A worker that loses its listening connection may have missed events. After reconnecting it reloads its state from
+the database and tells its live subscribers to resync.
+
+On by default, since there is no reliable way to tell how many workers uvicorn was started with (--workers doesn't
+set WEB_CONCURRENCY). With a single worker it costs one idle connection and a NOTIFY per write. Off by default on
+Vercel, where instances don't hold a connection open between requests. COORDINATE_WORKERS=0 or 1 overrides either,
+and a worker starting with it off says so in the log.
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+import psycopg2
+from psycopg2 import sql
+
+import db
+import pool
+import queries as q
+
+ENABLED = os.getenv('COORDINATE_WORKERS', '0' if os.getenv('VERCEL') else '1') == '1'
+CHANNEL = os.getenv('COORDINATION_CHANNEL', 'rapid_events')
+RECONNECT_DELAY = float(os.getenv('COORDINATION_RECONNECT_DELAY', 1))
+
+log = logging.getLogger(__name__)
+
+# Identifies this worker's own events, which it has already applied
+worker_id = uuid.uuid4().hex[:12]
+
+
+class Coordinator:
+    """
+    Sends and receives change events.
+        enabled: when False, announce() does nothing and no connection is opened
+        channel: NOTIFY channel shared by the workers
+    """
+    def __init__(self, enabled=ENABLED, channel=CHANNEL):
+        self.enabled = enabled
+        self.channel = channel
+        self.handlers = {}
+        self.on_resync = None
+        self._task = None
+        self.received = 0
+        self.resyncs = 0
+
+    def on(self, kind):
+        """
+        Registers a handler for events of kind. It is called with the event's fields as keyword arguments.
+        """
+        def register(handler):
+            self.handlers[kind] = handler
+            return handler
+        return register
+
+    async def announce(self, connection, kind, **fields):
+        """
+        Queues an event on connection's transaction, delivered to the other workers when it commits.
+        """
+        if not self.enabled:
+            return
+        payload = json.dumps({'origin': worker_id, 'kind': kind, **fields}, default=str)
+        await connection.execute(q.NOTIFY_EVENT, (self.channel, payload))
+
+    def _connect(self):
+        raw = psycopg2.connect(**pool.connection_settings())
+        raw.autocommit = True
+        with raw.cursor() as cursor:
+            cursor.execute(sql.SQL(q.LISTEN_EVENTS).format(sql.Identifier(self.channel)))
+        return raw
+
+    async def start(self):
+        """
+        Starts listening. Returns once LISTEN is in place, so state loaded after this can't miss an event.
+        """
+        if not self.enabled:
+            log.warning("Worker coordination is off (COORDINATE_WORKERS=0). With more than one worker, changes made "
+                        "through one of them won't reach the others' caches and live subscribers")
+            return
+        if self._task is not None:
+            return
+        raw = await db.run_blocking(self._connect)
+        self._task = asyncio.create_task(self._listen(raw))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _listen(self, raw):
+        while True:
+            try:
+                if raw is None:
+                    raw = await db.run_blocking(self._connect)
+                    await self._resync()
+                await self._receive(raw)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Coordination connection lost, reconnecting: %s", e)
+            finally:
+                if raw is not None:
+                    raw.close()
+                    raw = None
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _receive(self, raw):
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(raw.fileno(), readable.set)
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                # Non-blocking on an autocommit connection. Raises once the server has gone away
+                raw.poll()
+                while raw.notifies:
+                    self._dispatch(raw.notifies.pop(0).payload)
+        finally:
+            loop.remove_reader(raw.fileno())
+
+    def _dispatch(self, payload):
+        try:
+            event = json.loads(payload)
+            if event.pop('origin', None) == worker_id:
+                return
+            handler = self.handlers.get(event.pop('kind', None))
+            if handler is not None:
+                self.received += 1
+                handler(**event)
+        except Exception as e:
+            log.exception("Could not apply coordination event %s: %s", payload, e)
+
+    async def _resync(self):
+        self.resyncs += 1
+        if self.on_resync is not None:
+            await self.on_resync()
+
+    def stats(self):
+        return {'enabled': self.enabled, 'worker_id': worker_id, 'received': self.received, 'resyncs': self.resyncs}
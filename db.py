@@ -0,0 +1,231 @@
+"""
+Asyncio interface to the database. Routes await these helpers instead of calling pool.get_connection() directly,
+so a slow query only suspends the request that issued it instead of the whole event loop.
+
+psycopg2 is a blocking driver, so the statements themselves run on a thread executor sized to the pool while the
+calling coroutine yields. Checkouts wait in line on a semaphore when every connection is busy, and raise
+pool.PoolTimeout if none frees up within pool.ACQUIRE_TIMEOUT.
+
+Reads opened with readonly=True go to the read replica when replicas.router says it can serve them.
+"""
+import asyncio
+import functools
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import pool
+import prepared
+import queries as q
+import replicas
+
+# One worker thread per pooled connection, so a checked out connection never waits for a thread
+_executor = ThreadPoolExecutor(max_workers=pool.MAX_CONNECTIONS + pool.REPLICA_MAX_CONNECTIONS, thread_name_prefix="db")
+
+# Free connection slots per pool. Waiters are woken in arrival order
+_slots = asyncio.Semaphore(pool.MAX_CONNECTIONS)
+_replica_slots = asyncio.Semaphore(max(pool.REPLICA_MAX_CONNECTIONS, 1))
+
+log = logging.getLogger(__name__)
+
+router = replicas.ReplicaRouter(enabled=bool(pool.REPLICA_HOST))
+
+# Rows pulled per round-trip when streaming through a server-side cursor
+STREAM_BATCH_SIZE = 2000
+
+# Server-side cursor names only have to be unique per connection, a counter is plenty
+_cursor_names = itertools.count()
+
+
+class Pressure:
+    """
+    How backed up the primary pool is: checkouts waiting right now, and a moving average of recent checkout waits
+    that decays while nothing is checked out, so a past spike doesn't linger. admission.py sheds load on it.
+        half_life: seconds for the average to halve when idle
+    """
+    def __init__(self, smoothing=0.2, half_life=1.0):
+        self.smoothing = smoothing
+        self.half_life = half_life
+        self.waiting = 0
+        self._average = 0.0
+        self._updated = time.monotonic()
+
+    def observe(self, seconds):
+        average = self.average_wait()
+        self._average = average + self.smoothing * (seconds - average)
+        self._updated = time.monotonic()
+
+    def average_wait(self):
+        return self._average * 0.5 ** ((time.monotonic() - self._updated) / self.half_life)
+
+
+pressure = Pressure()
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """
+    Runs a blocking callable on the database executor and awaits its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+class Connection:
+    """
+    Awaitable wrapper around a pooled psycopg2 connection.
+        raw: the underlying psycopg2 connection
+    """
+    def __init__(self, raw):
+        self.raw = raw
+
+    def _fetch(self, query, params, one):
+        with self.raw.cursor() as cursor:
+            prepared.execute(self.raw, cursor, query, params)
+            return cursor.fetchone() if one else cursor.fetchall()
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Runs fn(raw_connection, *args) on the executor. Used for work that needs several statements in one hop.
+        """
+        return await run_blocking(fn, self.raw, *args, **kwargs)
+
+    async def execute(self, query, params=None):
+        def _execute(raw):
+            with raw.cursor() as cursor:
+                prepared.execute(raw, cursor, query, params)
+        await self.run(_execute)
+
+    async def fetchall(self, query, params=None):
+        return await run_blocking(self._fetch, query, params, False)
+
+    async def fetchone(self, query, params=None):
+        return await run_blocking(self._fetch, query, params, True)
+
+    async def iterate(self, query, params=None, batch_size=STREAM_BATCH_SIZE):
+        """
+        Streams the result of query in batches through a server-side (named) cursor, so only batch_size rows are
+        held in memory at a time. Yields lists of rows.
+        """
+        cursor = self.raw.cursor(name=f"stream_{next(_cursor_names)}")
+        try:
+            await run_blocking(cursor.execute, query, params)
+            while True:
+                rows = await run_blocking(cursor.fetchmany, batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            await run_blocking(cursor.close)
+
+    async def commit(self):
+        await run_blocking(self.raw.commit)
+
+    async def rollback(self):
+        await run_blocking(self.raw.rollback)
+
+
+async def _acquire(target, slots, load=None):
+    started = time.monotonic()
+    if load is not None:
+        load.waiting += 1
+    try:
+        await asyncio.wait_for(slots.acquire(), pool.ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        target.timeouts += 1
+        raise pool.PoolTimeout(f"no connection available within {pool.ACQUIRE_TIMEOUT}s")
+    finally:
+        if load is not None:
+            load.waiting -= 1
+            load.observe(time.monotonic() - started)
+    try:
+        # The wait so far counts towards the pool's wait time, and the deadline carries over
+        remaining = max(pool.ACQUIRE_TIMEOUT - (time.monotonic() - started), 0.001)
+        return await run_blocking(target.getconn, remaining, started)
+    except BaseException:
+        slots.release()
+        raise
+
+
+@asynccontextmanager
+async def connection(readonly=False):
+    """
+    Checks a connection out of the pool for the duration of the block and always gives it back.
+    Anything left uncommitted is rolled back when the connection is returned.
+        readonly: the block only reads, so it may be served by the read replica
+    """
+    target, slots, raw = None, None, None
+    if readonly and router.use_replica():
+        try:
+            target, slots = pool.get_replica_pool(), _replica_slots
+            raw = await _acquire(target, slots)
+        except Exception as e:
+            log.warning("Replica unavailable, reading from primary: %s", e)
+            router.failed()
+            raw = None
+    if raw is None:
+        target, slots = pool.get_pool(), _slots
+        raw = await _acquire(target, slots, pressure)
+    try:
+        yield Connection(raw)
+    finally:
+        try:
+            await run_blocking(target.putconn, raw)
+        finally:
+            slots.release()
+
+
+@asynccontextmanager
+async def transaction():
+    """
+    Like connection(), but commits when the block finishes and rolls back if it raises.
+    Always runs on the primary, and keeps the current client's reads there until the replica has caught up.
+    """
+    async with connection() as conn:
+        try:
+            yield conn
+        except BaseException:
+            await conn.rollback()
+            raise
+        await conn.commit()
+    router.note_write()
+
+
+async def replica_lag():
+    """
+    Seconds the replica is behind the primary. Zero when it has replayed everything it has received.
+    """
+    def _lag(raw):
+        with raw.cursor() as cursor:
+            cursor.execute(q.REPLICA_LAG)
+            return float(cursor.fetchone()[0])
+    target = pool.get_replica_pool()
+    raw = await _acquire(target, _replica_slots)
+    try:
+        return await run_blocking(_lag, raw)
+    finally:
+        try:
+            await run_blocking(target.putconn, raw)
+        finally:
+            _replica_slots.release()
+
+
+# Single statement helpers
+
+async def fetchall(query, params=None, readonly=False):
+    async with connection(readonly) as conn:
+        return await conn.fetchall(query, params)
+
+
+async def fetchone(query, params=None, readonly=False):
+    async with connection(readonly) as conn:
+        return await conn.fetchone(query, params)
+
+
+async def execute(query, params=None):
+    """
+    Runs a write statement and commits it.
+    """
+    async with transaction() as conn:
+        await conn.execute(query, params)
@@ -0,0 +1,65 @@
+"""
+In-process fan-out of change events to live subscribers (WebSocket and Server-Sent Events clients).
+
+An event is serialized once and dropped into every subscriber's queue, so a change costs the same whether one screen
+or a thousand are watching, and none of them has to poll the database.
+"""
+from contextlib import contextmanager
+import asyncio
+import json
+
+# Sent to a subscriber that fell too far behind, in place of the events it missed. It should refetch the full state
+RESYNC = json.dumps({"type": "resync"})
+
+
+class Broadcaster:
+    """
+    Publishes JSON events to every current subscriber.
+        queue_size: events buffered per subscriber before it is told to resync
+    """
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = set()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    @contextmanager
+    def subscribe(self):
+        """
+        Registers a subscriber for the duration of the block. Yields an asyncio.Queue of JSON strings.
+        """
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers.discard(queue)
+
+    def publish(self, event):
+        message = json.dumps(event, default=str)
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Replace the backlog with a single resync rather than block the publisher on a slow client
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESYNC)
+
+
+    def resync(self):
+        """
+        Tells every subscriber to refetch the full state, for when changes may have been missed.
+        """
+        for queue in self._subscribers:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(RESYNC)
+
+
+def sse(message):
+    """
+    Frames a JSON message as a Server-Sent Event.
+    """
+    return f"data: {message}\n\n"
@@ -0,0 +1,69 @@
+"""
+Streaming exports for the list routes. Rows are read through a server-side cursor and written out as NDJSON or CSV
+batch by batch, so memory use stays flat and the first bytes go out before the whole table has been read.
+"""
+import csv
+import io
+import json
+
+from fastapi.responses import StreamingResponse
+
+import db
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+# Pattern for the ?format= query parameter on exportable routes
+FORMAT_PATTERN = "^(ndjson|csv)$"
+
+
+def _csv_value(value):
+    # Nested values (order items) are written as JSON inside the cell
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+async def _ndjson(batches, to_json):
+    async for rows in batches:
+        yield "".join(json.dumps(to_json(row), default=str) + "\n" for row in rows)
+
+
+async def _csv(batches, to_json):
+    buffer = io.StringIO()
+    writer = None
+    async for rows in batches:
+        for row in rows:
+            record = to_json(row)
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=list(record))
+                writer.writeheader()
+            writer.writerow({key: _csv_value(value) for key, value in record.items()})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+async def _batches(query, params):
+    async with db.connection(readonly=True) as connection:
+        async for rows in connection.iterate(query, params):
+            yield rows
+
+
+def stream(query, to_json, export_format, filename, params=None):
+    """
+    Builds the StreamingResponse for an export.
+    Args:
+        query: SQL from queries.py
+        to_json: maps one row to the same dict the JSON route returns
+        export_format: "ndjson" or "csv"
+        filename: download name without extension
+    """
+    encode = _csv if export_format == "csv" else _ndjson
+    return StreamingResponse(
+        encode(_batches(query, params), to_json),
+        media_type=MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'},
+    )
@@ -0,0 +1,164 @@
+"""
+Idempotency-Key support for the write routes tablets retry on flaky Wi-Fi.
+
+The first request with a key runs normally, and its response is stored under the key in the same transaction as the
+write itself, so there is never an order without its stored response or the other way round. A retry with the same
+key gets the stored response back without touching the order or table rows.
+
+Two tiers:
+    a bounded in-process cache, which answers most retries without a query
+    public.idempotency_key, the durable record shared by every worker and kept across restarts
+
+A retry that arrives while the first request is still running waits for it: in-process through a shared future, and
+across workers on the row lock the first request's claim holds until it commits. A failed request stores nothing, so
+it can be retried with the same key. Keys live for IDEMPOTENCY_TTL seconds, and expired rows are deleted in the
+background when a worker starts and then every IDEMPOTENCY_PURGE_INTERVAL seconds.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from psycopg2.extras import Json
+
+import db
+import queries as q
+
+TTL = int(os.getenv('IDEMPOTENCY_TTL', 24 * 3600))
+CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000))
+PURGE_INTERVAL = float(os.getenv('IDEMPOTENCY_PURGE_INTERVAL', 600))
+MAX_KEY_LENGTH = 255
+
+log = logging.getLogger(__name__)
+
+
+class Mismatch(Exception):
+    """
+    The key was already used for a different request.
+    """
+
+
+def fingerprint(*parts):
+    """
+    Hash of what the request asked for, so a key reused for a different request is caught instead of replayed.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """
+        ttl: seconds a key is remembered
+        maxsize: entries kept in the in-process cache
+    """
+    def __init__(self, ttl=TTL, maxsize=CACHE_SIZE, purge_interval=PURGE_INTERVAL):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.purge_interval = purge_interval
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._purger = None
+        self.replays = 0
+
+    async def setup(self):
+        # public.idempotency_key is created by migrate.py
+        if self._purger is None:
+            self._purger = asyncio.create_task(self._purge_periodically())
+
+    async def _purge_periodically(self):
+        # Every worker purges. The DELETE only removes expired rows, so running it twice is harmless
+        while True:
+            try:
+                await db.execute(q.PURGE_IDEMPOTENCY_KEYS, (self.ttl, ))
+            except Exception as e:
+                log.warning("Could not purge expired idempotency keys: %s", e)
+            await asyncio.sleep(self.purge_interval)
+
+    async def stop(self):
+        if self._purger is not None:
+            self._purger.cancel()
+            try:
+                await self._purger
+            except asyncio.CancelledError:
+                pass
+            self._purger = None
+
+    def _cached(self, entry_key):
+        entry = self._cache.get(entry_key)
+        if entry is None:
+            return None
+        if entry[2] <= time.monotonic():
+            del self._cache[entry_key]
+            return None
+        self._cache.move_to_end(entry_key)
+        return entry
+
+    def _remember(self, entry_key, request_hash, body):
+        self._cache[entry_key] = (request_hash, body, time.monotonic() + self.ttl)
+        self._cache.move_to_end(entry_key)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def _replay(self, request_hash, stored_hash, body):
+        if stored_hash != request_hash:
+            raise Mismatch()
+        self.replays += 1
+        return body, True
+
+    async def run(self, scope, key, request_hash, write):
+        """
+        Runs write(connection) in a transaction once per (scope, key).
+        Args:
+            scope: the route, so the same key on two routes doesn't collide
+            key: the Idempotency-Key header, or None to just run write
+            request_hash: fingerprint() of the request
+            write: coroutine function taking the transaction's connection and returning the JSON response body
+        Returns:
+            (body, replayed)
+        """
+        if key is None:
+            async with db.transaction() as connection:
+                return await write(connection), False
+
+        entry_key = (scope, key)
+        entry = self._cached(entry_key)
+        if entry is not None:
+            return self._replay(request_hash, entry[0], entry[1])
+
+        running = self._inflight.get(entry_key)
+        if running is not None:
+            stored_hash, body = await asyncio.shield(running)
+            return self._replay(request_hash, stored_hash, body)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[entry_key] = future
+        try:
+            stored_hash, body, replayed = await self._run(scope, key, request_hash, write)
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+            # Nobody else may be waiting, don't let the event loop complain about an unretrieved exception
+            future.exception()
+            raise
+        else:
+            future.set_result((stored_hash, body))
+        finally:
+            self._inflight.pop(entry_key, None)
+
+        self._remember(entry_key, stored_hash, body)
+        if replayed:
+            return self._replay(request_hash, stored_hash, body)
+        return body, False
+
+    async def _run(self, scope, key, request_hash, write):
+        async with db.transaction() as connection:
+            # Waits here if another worker holds the same key, until it commits or rolls back
+            claimed = await connection.fetchone(q.CLAIM_IDEMPOTENCY_KEY, (scope, key, request_hash, self.ttl))
+            if claimed is None:
+                stored = await connection.fetchone(q.GET_IDEMPOTENT_RESPONSE, (scope, key))
+                return stored.request_hash, stored.response, True
+            body = await write(connection)
+            await connection.execute(q.SAVE_IDEMPOTENT_RESPONSE, (Json(body), scope, key))
+        return request_hash, body, False
@@ -0,0 +1,108 @@
+"""
+DataLoader-style batching for the per-id GET routes.
+
+Identical lookups that are already in flight share one query (singleflight). Distinct keys that arrive within a
+short window are gathered into a single WHERE ... = ANY(%s) query. Nothing is cached once a batch resolves, so
+results are never staler than a direct query.
+"""
+import asyncio
+
+# Seconds to wait for more keys before sending a batch
+DEFAULT_WINDOW = 0.002
+DEFAULT_MAX_BATCH = 200
+
+
+class Loader:
+    """
+    Collects keys and resolves them in batches.
+        batch_fn: coroutine function taking a list of keys and returning a dict of key -> value
+        default: value for keys missing from batch_fn's result
+        window: seconds to wait for more keys before dispatching
+        max_batch: dispatch straight away once this many keys are waiting
+    """
+    def __init__(self, batch_fn, default=None, window=DEFAULT_WINDOW, max_batch=DEFAULT_MAX_BATCH):
+        self.batch_fn = batch_fn
+        self.default = default
+        self.window = window
+        self.max_batch = max_batch
+        self._inflight = {}
+        self._pending = {}
+        self._timer = None
+        self._running = set()
+        self.batches = 0
+        self.loads = 0
+
+    async def load(self, key):
+        self.loads += 1
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._inflight[key] = future
+            self._pending[key] = future
+            if len(self._pending) >= self.max_batch:
+                self._dispatch()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._dispatch)
+        # Shielded so one caller giving up doesn't cancel the lookup for everyone sharing it
+        return await asyncio.shield(future)
+
+    def clear(self, key=None):
+        """
+        Stops later load() calls from joining a lookup for key (every key when None) that was already sent, so a
+        read that starts after a write never shares a query that started before it. Whoever is already waiting still
+        gets that query's result. Keys still waiting for their batch are kept, their query hasn't been sent yet.
+        """
+        keys = list(self._inflight) if key is None else [key]
+        for key in keys:
+            if key not in self._pending:
+                self._inflight.pop(key, None)
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch):
+        self.batches += 1
+        try:
+            results = await self.batch_fn(list(batch))
+        except Exception as e:
+            for key, future in batch.items():
+                self._settle(key, future, error=e)
+        else:
+            for key, future in batch.items():
+                self._settle(key, future, value=results.get(key, self.default))
+        finally:
+            # Cancelled (e.g. at shutdown): nobody may be left waiting on a future that will never resolve
+            for key, future in batch.items():
+                self._settle(key, future, cancel=True)
+
+    def _settle(self, key, future, value=None, error=None, cancel=False):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if future.done():
+            return
+        if cancel:
+            future.cancel()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+
+def group_rows(rows, column):
+    """
+    Buckets rows by the named column, for batch functions whose keys can match several rows.
+    Returns:
+        dict of key -> list of rows
+    """
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(getattr(row, column), []).append(row)
+    return grouped
@@ -1,33 +1,145 @@
 """
- 
- Log information for logging, also might offload to blob storage or something?
+Logging for the API.
 
- """
+Request handlers never touch a file or the console themselves. setup() puts a QueueHandler on the root logger, so
+logging a record is only an append to an in-memory queue, and a QueueListener thread does the formatting and the
+writing. Records come out as one JSON object per line, tagged with the id of the request that logged them.
+
+Settings, read from the environment when setup() runs, after app.py has loaded .env:
+    LOG_LEVEL: root level, INFO by default
+    LOG_FILE: also write to this file, rotated (console only when unset, e.g. on Vercel's read-only filesystem)
+    LOG_ROTATE: "size" (LOG_MAX_BYTES per file) or "time" (at LOG_ROTATE_WHEN, midnight by default)
+    LOG_BACKUPS: rotated files to keep
+    LOG_SAMPLE_DEBUG, LOG_SAMPLE_INFO: fraction of access log records (the ACCESS_LOGGER logger) kept at that level.
+    Every other logger, and warnings and errors, are always kept.
+"""
+import atexit
+import contextvars
+import copy
 import datetime
+import json
 import logging
-from logging.handlers import RotatingFileHandler
 import os
-import os.path
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+# Set per request by the middleware in app.py
+request_id = contextvars.ContextVar('request_id', default=None)
+
+# One record per request, the only logger that is sampled
+ACCESS_LOGGER = "app.access"
+
+# Attributes every LogRecord has. Anything else was passed through extra= and goes into the JSON
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+_listener = None
+
+
+class ContextFilter(logging.Filter):
+    """
+    Stamps records with the current request id. Runs on the QueueHandler, in the thread that logged, since the
+    request id is gone by the time the listener thread sees the record.
+    """
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """
+    Drops a share of the records at each level in rates, e.g. {logging.INFO: 0.1} keeps one INFO record in ten.
+    """
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = rates or {}
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1)
+        return rate >= 1 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Formatting is left to the listener thread. Only resolve the message and render the traceback here, while
+        # the arguments and the exception still exist
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _file_handler(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    backups = int(os.getenv('LOG_BACKUPS', 7))
+    if os.getenv('LOG_ROTATE', 'size') == 'time':
+        return TimedRotatingFileHandler(path, when=os.getenv('LOG_ROTATE_WHEN', 'midnight'), backupCount=backups, utc=True)
+    return RotatingFileHandler(path, maxBytes=int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024)), backupCount=backups)
 
 
-date = datetime.datetime.now().strftime("%Y-%m-%d")
-log_dir = "logs"
-log_filename = os.path.join(f'{date}.log')
+def setup():
+    """
+    Routes the root logger through the queue. Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
 
-os.makedirs(log_dir, exist_ok=True)
+    formatter = JsonFormatter()
+    handlers = [logging.StreamHandler()]
+    log_file = os.getenv('LOG_FILE')
+    if log_file:
+        handlers.append(_file_handler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
 
-logger = logging.getLogger()
-logFormatter = logging.Formatter("%(asctime)s-%(levelname)s-%(name)s-%(message)s", datefmt="%H:%M:%S")
+    records = queue.SimpleQueue()
+    queue_handler = _QueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+    logging.getLogger(ACCESS_LOGGER).addFilter(SampleFilter({
+        logging.DEBUG: float(os.getenv('LOG_SAMPLE_DEBUG', 1)),
+        logging.INFO: float(os.getenv('LOG_SAMPLE_INFO', 1)),
+    }))
 
-# log to console
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-logger.addHandler(consoleHandler)
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
 
-# log to log/file.log
-fileHandler = logging.FileHandler(log_filename)
-fileHandler.setFormatter(logFormatter)
-logger.addHandler(fileHandler)
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop)
 
 
-#logging.basicConfig(filename=log_filename, format="%(levelname)s:%(name)s:%(message)s")
\ No newline at end of file
+def stop():
+    """
+    Writes out whatever is still queued and stops the listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
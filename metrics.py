@@ -0,0 +1,233 @@
+"""
+Lightweight counters and histograms for instrumenting the API. Cheap enough to leave on in production: an
+observation is a bisect and two additions.
+
+Collected here:
+    per-route request latency and status counts (MetricsMiddleware)
+    per-statement execution time, labelled with the queries.py constant name (TimedCursor)
+Pool wait and checkout times live on the pool itself and are added by collectors registered from app.py.
+render() writes everything in the Prometheus text format for GET /metrics.
+"""
+import bisect
+import threading
+import time
+
+from psycopg2.extensions import cursor as _cursor
+
+import queries as q
+
+# Seconds. Covers a fast pool checkout up to a request that is already far too slow
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram in the Prometheus style.
+        buckets: sorted upper bounds, +Inf is implied
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[position] += 1
+            self.sum += value
+            self.count += 1
+
+    def cumulative(self):
+        """
+        Returns [(upper_bound, count of observations <= upper_bound)], ending with +Inf.
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"), ), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-th quantile. Rough, but enough to spot a regression.
+        """
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        for bound, total in self.cumulative():
+            if total >= target:
+                return bound
+        return float("inf")
+
+
+class LabeledHistogram:
+    """
+    One Histogram per combination of label values.
+    """
+    def __init__(self, name, help, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.children = {}
+
+    def labels_for(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, Histogram(self.buckets))
+        return child
+
+    def observe(self, value, *label_values):
+        self.labels_for(*label_values).observe(value)
+
+
+class LabeledCounter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.children = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.children[label_values] = self.children.get(label_values, 0) + amount
+
+
+request_latency = LabeledHistogram("http_request_duration_seconds", "Request latency by route", ("method", "route"))
+request_status = LabeledCounter("http_requests_total", "Responses by route and status", ("method", "route", "status"))
+query_latency = LabeledHistogram("db_query_duration_seconds", "Statement execution time, pool wait excluded", ("query", ))
+query_errors = LabeledCounter("db_query_errors_total", "Statements that raised", ("query", ))
+
+_families = [request_latency, request_status, query_latency, query_errors]
+_collectors = []
+
+
+"""
+Query timing
+"""
+
+# SQL text -> queries.py constant name. prepared.py adds its EXECUTE forms under the same names
+QUERY_NAMES = {value: name for name, value in vars(q).items() if name.isupper() and isinstance(value, str)}
+
+
+def query_name(query):
+    name = QUERY_NAMES.get(query)
+    if name is not None:
+        return name
+    # Ad hoc SQL (execute_values pages, PREPARE, SAVEPOINT...) is labelled by its first keyword to keep cardinality low
+    if isinstance(query, bytes):
+        query = query[:16].decode(errors="ignore")
+    head = query.lstrip().split(None, 1)
+    return head[0].lower() if head else "other"
+
+
+class TimedCursor(_cursor):
+    """
+    psycopg2 cursor that records how long each execute takes under the statement's name. Part of the cursor_factory
+    every pooled connection uses (rows.Cursor).
+    """
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        except Exception:
+            query_errors.inc(query_name(query))
+            raise
+        finally:
+            query_latency.observe(time.perf_counter() - started, query_name(query))
+
+
+"""
+Request timing
+"""
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency and status per route template (/table/{table_number}, not /table/7), so the
+    number of series stays bounded.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            request_latency.observe(time.perf_counter() - started, scope["method"], path)
+            request_status.inc(scope["method"], path, str(status[0]))
+
+
+"""
+Exposition
+"""
+
+def register_collector(collect):
+    """
+    collect() returns extra samples as a list of (name, type, help, {labels: value}) tuples, read on every scrape.
+    """
+    _collectors.append(collect)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _bound(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def _histogram_lines(name, label_names, label_values, histogram):
+    lines = []
+    for bound, total in histogram.cumulative():
+        labels = _labels(label_names + ("le", ), label_values + (_bound(bound), ))
+        lines.append(f"{name}_bucket{labels} {total}")
+    labels = _labels(label_names, label_values)
+    lines.append(f"{name}_sum{labels} {histogram.sum}")
+    lines.append(f"{name}_count{labels} {histogram.count}")
+    return lines
+
+
+def render():
+    lines = []
+    for family in _families:
+        kind = "histogram" if isinstance(family, LabeledHistogram) else "counter"
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {kind}")
+        for label_values, child in list(family.children.items()):
+            if kind == "histogram":
+                lines.extend(_histogram_lines(family.name, family.labels, label_values, child))
+            else:
+                lines.append(f"{family.name}{_labels(family.labels, label_values)} {child}")
+
+    for collect in _collectors:
+        for name, kind, help, samples in collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                lines.extend(_histogram_lines(name, (), (), samples))
+                continue
+            for labels, value in samples.items():
+                label_names = tuple(key for key, _ in labels)
+                label_values = tuple(value for _, value in labels)
+                lines.append(f"{name}{_labels(label_names, label_values)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,130 @@
+"""
+Schema setup, run once per deploy before the new version starts serving:
+
+    python migrate.py
+
+Every step is safe to run again, so each deploy simply runs them all. A session advisory lock keeps two deploys from
+migrating at the same time. Indexes on tables that already hold data are built CONCURRENTLY, which doesn't block
+writes but can't run inside a transaction. A build that failed half way leaves an invalid index behind, which is
+dropped and built again on the next run.
+
+Workers never change the schema. At startup they only run check(), one catalog query that reports anything missing.
+"""
+import logging
+import os
+
+import psycopg2
+from psycopg2 import sql
+
+import analytics
+import queries as q
+
+log = logging.getLogger("migrate")
+
+# (function, in a transaction), in the order they run
+STEPS = []
+# Relations check() expects to find, added by each step
+REQUIRED = []
+
+
+def step(transaction=True, creates=()):
+    """
+    Registers a function taking a cursor as a migration step.
+        transaction: False runs it in autocommit, for statements like CREATE INDEX CONCURRENTLY
+        creates: relations the step creates, looked for by check()
+    """
+    def register(function):
+        STEPS.append((function, transaction))
+        REQUIRED.extend(creates)
+        return function
+    return register
+
+
+def build_index(cursor, name, statement):
+    cursor.execute(q.GET_INDEX_VALID, (name, ))
+    row = cursor.fetchone()
+    if row is not None and not row[0]:
+        log.warning("Dropping %s, left invalid by a failed build", name)
+        cursor.execute(sql.SQL(q.DROP_INDEX).format(sql.Identifier(*name.split("."))))
+    cursor.execute(statement)
+
+
+@step(creates=("public.table_expiry", ))
+def table_expiries(cursor):
+    cursor.execute(q.CREATE_TABLE_EXPIRY_TABLE)
+
+
+@step(creates=("public.idempotency_key", ))
+def idempotency_keys(cursor):
+    cursor.execute(q.CREATE_IDEMPOTENCY_TABLE)
+
+
+@step(creates=("public.booking", ))
+def bookings(cursor):
+    # btree_gist provides the exclusion constraint that keeps a table from being booked twice for the same time
+    cursor.execute(q.CREATE_BOOKING_EXTENSION)
+    cursor.execute(q.CREATE_BOOKING_TABLE)
+
+
+@step(creates=("public.table_rollup", "public.food_rollup", "public.hourly_rollup"))
+def rollups(cursor):
+    cursor.execute(q.CREATE_TABLE_ROLLUP)
+    cursor.execute(q.CREATE_FOOD_ROLLUP)
+    cursor.execute(q.CREATE_HOURLY_ROLLUP)
+    analytics.backfill(cursor)
+
+
+@step(transaction=False, creates=("public.customer_name_trgm", "public.customer_email_trgm",
+                                  "public.customer_phone_trgm"))
+def search_indexes(cursor):
+    cursor.execute(q.CREATE_SEARCH_EXTENSION)
+    build_index(cursor, "public.customer_name_trgm", q.CREATE_CUSTOMER_NAME_INDEX)
+    build_index(cursor, "public.customer_email_trgm", q.CREATE_CUSTOMER_EMAIL_INDEX)
+    build_index(cursor, "public.customer_phone_trgm", q.CREATE_CUSTOMER_PHONE_INDEX)
+
+
+def migrate(raw):
+    """
+    Runs every step on raw, a psycopg2 connection.
+    """
+    raw.autocommit = True
+    with raw.cursor() as cursor:
+        cursor.execute(q.LOCK_MIGRATIONS)
+        for function, transaction in STEPS:
+            raw.autocommit = not transaction
+            function(cursor)
+            if transaction:
+                raw.commit()
+            log.info("Applied %s", function.__name__)
+
+
+async def check(fetchall):
+    """
+    Logs an error naming every REQUIRED relation that doesn't exist, for a deploy that skipped this script.
+        fetchall: coroutine function taking (query, params), e.g. db.fetchall
+    Returns:
+        the missing relations
+    """
+    missing = [row.name for row in await fetchall(q.GET_MISSING_RELATIONS, (REQUIRED, ))]
+    if missing:
+        log.error("Missing %s, run python migrate.py", ", ".join(missing))
+    return missing
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    # Only the connection settings are needed here, not an open pool
+    os.environ['POSTGRES_POOL_LAZY'] = '1'
+    import pool
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    raw = psycopg2.connect(**pool.connection_settings())
+    try:
+        migrate(raw)
+    finally:
+        raw.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 # Table Item
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, Field
+from datetime import datetime
+from typing import List, Optional
  
 """
 Table Data Object
@@ -24,4 +25,20 @@ class OrderItem(BaseModel):
 class Order(BaseModel):
     table_number: int
     customer_id: int
-    items: List[OrderItem]
\ No newline at end of file
+    items: List[OrderItem]
+
+
+"""
+Booking Data Object, a table held for a future time slot
+    table_id: integer
+    customer_id: integer, optional
+    party_size: integer, at least 1
+    start: datetime, naive values are taken as UTC
+    end: datetime
+"""
+class Booking(BaseModel):
+    table_id: int
+    customer_id: Optional[int] = None
+    party_size: int = Field(gt=0)
+    start: datetime
+    end: datetime
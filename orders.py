@@ -0,0 +1,126 @@
+"""
+Writes orders into public.order and public.order_items, and turns their rows back into the JSON shape returned by
+the order routes.
+"""
+import os
+
+from psycopg2.extras import execute_values
+
+import prepared
+import queries as q
+
+# Most orders POST /orders/place accepts in one request, the whole batch is written in a single transaction
+MAX_BATCH = int(os.getenv('ORDERS_MAX_BATCH', 500))
+
+
+def unique_items(items):
+    """
+    Quick duplicate filter for order items
+    Will throw away an order item if it's associated food id is already present to avoid errors
+    """
+    food_item_ids = set()
+    unique_food_items = []
+    for order_item in items:
+        if order_item.food_id not in food_item_ids:
+            unique_food_items.append(order_item)
+            food_item_ids.add(order_item.food_id)
+    return unique_food_items
+
+
+def _item_rows(order_id, order):
+    return [(order_item.food_id, order_id, order_item.quantity) for order_item in unique_items(order.items)]
+
+
+def write_order(connection, order):
+    """
+    Inserts one order and all of its items: two statements, no commit. Runs on the database executor.
+    Args:
+        connection: raw psycopg2 connection, inside the caller's transaction
+        order: models.Order
+    Returns:
+        the new order_id
+    """
+    with connection.cursor() as cursor:
+        prepared.execute(connection, cursor, q.CREATE_ORDER, (order.customer_id, order.table_number, ))
+        order_id = cursor.fetchone()[0]
+        item_rows = _item_rows(order_id, order)
+        if item_rows:
+            execute_values(cursor, q.CREATE_ORDER_ITEMS, item_rows, page_size=len(item_rows))
+    return order_id
+
+
+def write_orders(connection, orders):
+    """
+    Inserts a batch of orders and all of their items in three statements, no commit. Runs on the database executor.
+    Returns:
+        the new order_ids, in the same order as orders
+    """
+    if not orders:
+        return []
+    with connection.cursor() as cursor:
+        prepared.execute(connection, cursor, q.RESERVE_ORDER_IDS, (len(orders), ))
+        order_ids = [row[0] for row in cursor.fetchall()]
+        execute_values(cursor, q.CREATE_ORDERS_WITH_ID,
+                       [(order_id, order.customer_id, order.table_number) for order_id, order in zip(order_ids, orders)],
+                       page_size=len(orders))
+        item_rows = [row for order_id, order in zip(order_ids, orders) for row in _item_rows(order_id, order)]
+        if item_rows:
+            execute_values(cursor, q.CREATE_ORDER_ITEMS, item_rows, page_size=len(item_rows))
+    return order_ids
+
+
+def order_items_to_json(order_items):
+    return [
+        {
+            "food_id": order_item.food_id,
+            "quantity": order_item.quantity
+        }
+
+        for order_item in order_items
+    ]
+
+
+def order_to_json(order, order_items):
+    return {
+        "order_id": order.order_id,
+        "table_number": order.table_id,
+        "customer_id": order.customer_id,
+        "items": order_items_to_json(order_items)
+    }
+
+
+def group_order_items(order_items):
+    """
+    Buckets order_items rows by their order_id in a single pass.
+    Returns:
+        dict of order_id -> list of order_items rows
+    """
+    grouped = {}
+    for order_item in order_items:
+        bucket = grouped.get(order_item.order_id)
+        if bucket is None:
+            grouped[order_item.order_id] = [order_item]
+        else:
+            bucket.append(order_item)
+    return grouped
+
+
+def assemble_orders(orders, order_items):
+    """
+    Attaches each order's items to it. Linear in the number of rows, where matching every order against the whole
+    item list was quadratic.
+    """
+    grouped = group_order_items(order_items)
+    return [order_to_json(row, grouped.get(row.order_id, ())) for row in orders]
+
+
+def exported_order_to_json(row):
+    """
+    Maps a row of EXPORT_ALL_ORDERS, whose last column already holds the aggregated items.
+    """
+    return {
+        "order_id": row.order_id,
+        "table_number": row.table_id,
+        "customer_id": row.customer_id,
+        "items": row.items
+    }
@@ -0,0 +1,122 @@
+"""
+Keyset pagination and field projection for the list routes.
+
+A page is "the next limit rows after this primary key", so it costs the same however deep the client has scrolled,
+unlike OFFSET. The client gets the position back as an opaque `next` token and passes it as `after` to read on.
+
+fields= narrows the SELECT to the named response fields. Field names are checked against each listing's whitelist
+before they get anywhere near the SQL, and the primary key is always read so the next token can be built.
+"""
+import base64
+import bisect
+import json
+
+import metrics
+import queries as q
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps([key]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """
+    Raises ValueError for a token this module didn't produce.
+    """
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode()))[0]
+    except Exception:
+        key = None
+    # Every listing is keyed on an integer primary key
+    if not isinstance(key, int) or isinstance(key, bool):
+        raise ValueError("Invalid after token")
+    return key
+
+
+def parse_fields(fields, allowed):
+    """
+    Splits a fields= value into the requested field names, in response order. None means every field.
+    """
+    if not fields:
+        return list(allowed)
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed)}")
+    return list(dict.fromkeys(requested))
+
+
+def envelope(items, next_key):
+    return {'items': items, 'next': encode_cursor(next_key) if next_key is not None else None}
+
+
+class Listing:
+    """
+    One paginated list route.
+        name: used to label the generated queries in metrics
+        table: table to read
+        key: integer primary key column, the pagination order
+        columns: response field -> column, in response order. A column of None marks a field the route fills in
+        itself (order items), which is never selected
+    """
+    def __init__(self, name, table, key, columns):
+        self.name = name
+        self.table = table
+        self.key = key
+        self.columns = columns
+        self._queries = {}
+
+    def query(self, fields, paged):
+        selected = tuple(field for field in fields if self.columns[field] is not None)
+        cache_key = (selected, paged)
+        sql = self._queries.get(cache_key)
+        if sql is None:
+            # The key is always read, so the next token can be built
+            names = list(dict.fromkeys([self.columns[field] for field in selected] + [self.key]))
+            template = q.LIST_NEXT_PAGE if paged else q.LIST_FIRST_PAGE
+            sql = template.format(columns=", ".join(names), table=self.table, key=self.key)
+            self._queries[cache_key] = sql
+            metrics.QUERY_NAMES[sql] = f"LIST_{self.name.upper()}"
+        return selected, sql
+
+    async def page(self, fetchall, fields, after=None, limit=None):
+        """
+        Reads one page. fetchall is a coroutine function taking (query, params).
+        Returns:
+            (keys, records, next_key): the primary key of each record, the records as dicts holding the requested
+            fields, and next_key, None on the last page
+        """
+        selected, sql = self.query(fields, after is not None)
+        # One extra row tells whether there is another page. LIMIT NULL reads everything
+        fetch = limit + 1 if limit else None
+        params = (after, fetch) if after is not None else (fetch, )
+        rows = await fetchall(sql, params)
+        more = limit is not None and len(rows) > limit
+        if more:
+            rows = rows[:limit]
+
+        keys = [getattr(row, self.key) for row in rows]
+        next_key = keys[-1] if more else None
+        records = [{field: getattr(row, self.columns[field]) for field in selected} for row in rows]
+        return keys, records, next_key
+
+
+def slice_sorted(rows, key, after=None, limit=None):
+    """
+    The same paging over rows already held in memory and sorted by key (the cached table list).
+    Returns:
+        (rows, next_key)
+    """
+    start = bisect.bisect_right([key(row) for row in rows], after) if after is not None else 0
+    end = start + limit if limit else len(rows)
+    page = rows[start:end]
+    next_key = key(page[-1]) if page and end < len(rows) else None
+    return page, next_key
+
+
+def project(record, fields):
+    return {field: record[field] for field in fields}
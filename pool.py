@@ -1,29 +1,301 @@
 """
 Creates an always open connection that prevents closing and reopening the access point which causes major delays.
+
+With POSTGRES_POOL_LAZY=1 (the default on Vercel) the pool isn't opened at import, but on the first checkout, so a
+cold start can begin serving before it has talked to Postgres.
+
+The pool hands connections out in arrival order and waits up to POSTGRES_POOL_TIMEOUT seconds when all of them are
+busy, instead of failing straight away. Connections are checked before reuse and replaced once they get old. Wait
+and checkout times are recorded for the metrics.
 """
-from psycopg2 import pool
-from dotenv import load_dotenv
+from collections import deque
+from contextlib import contextmanager
+import itertools
 import os
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+from metrics import Histogram
+from rows import Cursor
+
+# Sizing, adjust as needed through the environment
+MIN_CONNECTIONS = int(os.getenv('POSTGRES_POOL_MIN', 2))
+MAX_CONNECTIONS = int(os.getenv('POSTGRES_POOL_MAX', 10))
+# Seconds to wait for a free connection before giving up
+ACQUIRE_TIMEOUT = float(os.getenv('POSTGRES_POOL_TIMEOUT', 10))
+# Seconds a connection is kept before it is closed and replaced
+MAX_LIFETIME = float(os.getenv('POSTGRES_POOL_MAX_LIFETIME', 1800))
+# Seconds a connection can sit idle before it is pinged on checkout
+IDLE_CHECK = float(os.getenv('POSTGRES_POOL_IDLE_CHECK', 30))
+# Optional read replica, see replicas.py. Database, user and password default to the primary's
+REPLICA_HOST = os.getenv('POSTGRES_REPLICA_HOST')
+REPLICA_MAX_CONNECTIONS = int(os.getenv('POSTGRES_REPLICA_POOL_MAX', MAX_CONNECTIONS)) if REPLICA_HOST else 0
+# Open the pool on first use instead of at import. Vercel sets VERCEL=1 on its deployments
+LAZY = os.getenv('POSTGRES_POOL_LAZY', '1' if os.getenv('VERCEL') else '0') == '1'
+
+
+class PoolTimeout(PoolError):
+    """
+    Raised when no connection frees up within the acquire timeout.
+    """
+
+
+class ConnectionPool:
+    """
+    Thread safe psycopg2 connection pool with a fair wait queue, liveness checks and max-lifetime recycling.
+        minconn: connections opened up front and kept warm
+        maxconn: hard limit on open connections
+        timeout: default seconds to wait in getconn, None waits forever
+        max_lifetime: seconds before a connection is recycled
+        idle_check: seconds idle before a connection is pinged on checkout
+        kwargs: passed to psycopg2.connect
+    """
+    def __init__(self, minconn, maxconn, timeout=None, max_lifetime=None, idle_check=None, **kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.idle_check = idle_check
+        self._kwargs = kwargs
+
+        self._cond = threading.Condition()
+        self._idle = deque()        # (connection, opened_at, idle_since)
+        self._in_use = {}           # connection -> (opened_at, checked_out_at)
+        self._opened = 0
+        self._queue = deque()
+        self._tickets = itertools.count()
+
+        self.wait_time = Histogram()
+        self.checkout_time = Histogram()
+        self.acquired = 0
+        self.timeouts = 0
+        self.discarded = 0
+
+        for _ in range(minconn):
+            self._opened += 1
+            self._idle.append((self._connect(), time.monotonic(), time.monotonic()))
+
+    def _connect(self):
+        return psycopg2.connect(cursor_factory=Cursor, **self._kwargs)
+
+    def _expired(self, opened_at, now):
+        return self.max_lifetime is not None and now - opened_at > self.max_lifetime
+
+    def _alive(self, connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self, timeout=None, started=None):
+        """
+        Takes a connection, waiting in line behind earlier callers if none is free.
+        Args:
+            timeout: seconds to wait, defaults to the pool's timeout
+            started: time.monotonic() at which the caller started waiting, if it queued elsewhere first
+        """
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic() if started is None else started
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._cond:
+            ticket = next(self._tickets)
+            self._queue.append(ticket)
+            try:
+                while self._queue[0] != ticket or (not self._idle and self._opened >= self.maxconn):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(f"no connection available within {timeout}s")
+                    self._cond.wait(remaining)
+            finally:
+                self._queue.remove(ticket)
+                # Let the next in line re-check now that the head of the queue moved
+                self._cond.notify_all()
+
+            entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                self._opened += 1
 
-# Load info from .env file
-load_dotenv()
+        connection = self._checkout(entry)
+        now = time.monotonic()
+        self.wait_time.observe(now - started)
+        self.acquired += 1
+        return connection
 
-# Create a connection pool that always has atleast 1 connection, and can support up to 10. We can adjust as needed
-connection_pool = pool.ThreadedConnectionPool(
-    minconn=2,
-    maxconn=10,
-    host=os.getenv('POSTGRES_HOST'),
-    database=os.getenv('POSTGRES_DATABASE'),
-    user=os.getenv("POSTGRES_USER"),
-    password=os.getenv("POSTGRES_PASSWORD")
-)
+    def _checkout(self, entry):
+        # Runs outside the lock, the caller already owns this slot
+        now = time.monotonic()
+        if entry is not None:
+            connection, opened_at, idle_since = entry
+            stale = connection.closed or self._expired(opened_at, now)
+            if not stale and self.idle_check is not None and now - idle_since > self.idle_check:
+                stale = not self._alive(connection)
+            if not stale:
+                self._in_use[connection] = (opened_at, now)
+                return connection
+            self.discarded += 1
+            self._close(connection)
+        try:
+            connection = self._connect()
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify_all()
+            raise
+        now = time.monotonic()
+        self._in_use[connection] = (now, now)
+        return connection
+
+    def putconn(self, connection, close=False):
+        """
+        Returns a connection. Anything left uncommitted is rolled back.
+        """
+        opened_at, checked_out_at = self._in_use.pop(connection)
+        now = time.monotonic()
+        self.checkout_time.observe(now - checked_out_at)
+
+        if not close and not connection.closed:
+            status = connection.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    close = True
+        if close or connection.closed or self._expired(opened_at, now):
+            self._close(connection)
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify_all()
+            return
+
+        with self._cond:
+            self._idle.append((connection, opened_at, now))
+            self._cond.notify_all()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Checks a connection out for the duration of the block and always gives it back.
+        """
+        connection = self.getconn(timeout)
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._opened,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'waiting': len(self._queue),
+                'acquired': self.acquired,
+                'timeouts': self.timeouts,
+                'discarded': self.discarded,
+            }
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                self._close(self._idle.pop()[0])
+                self._opened -= 1
+
+
+_pool = None
+_replica_pool = None
+_pool_lock = threading.Lock()
+
+
+def connection_settings():
+    """
+    Connection arguments for the primary, for the pool and for connections that live outside it.
+    """
+    return {
+        'host': os.getenv('POSTGRES_HOST'),
+        'database': os.getenv('POSTGRES_DATABASE'),
+        'user': os.getenv("POSTGRES_USER"),
+        'password': os.getenv("POSTGRES_PASSWORD"),
+    }
+
+
+def get_pool():
+    """
+    Returns the shared pool, opening it on the first call.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    minconn=MIN_CONNECTIONS,
+                    maxconn=MAX_CONNECTIONS,
+                    timeout=ACQUIRE_TIMEOUT,
+                    max_lifetime=MAX_LIFETIME,
+                    idle_check=IDLE_CHECK,
+                    **connection_settings()
+                )
+    return _pool
+
+
+def get_replica_pool():
+    """
+    Returns the read replica pool, opening it on the first call, or None when no replica is configured.
+    """
+    global _replica_pool
+    if REPLICA_HOST and _replica_pool is None:
+        with _pool_lock:
+            if _replica_pool is None:
+                _replica_pool = ConnectionPool(
+                    minconn=0,
+                    maxconn=REPLICA_MAX_CONNECTIONS,
+                    timeout=ACQUIRE_TIMEOUT,
+                    max_lifetime=MAX_LIFETIME,
+                    idle_check=IDLE_CHECK,
+                    host=REPLICA_HOST,
+                    database=os.getenv('POSTGRES_REPLICA_DATABASE', os.getenv('POSTGRES_DATABASE')),
+                    user=os.getenv('POSTGRES_REPLICA_USER', os.getenv("POSTGRES_USER")),
+                    password=os.getenv('POSTGRES_REPLICA_PASSWORD', os.getenv("POSTGRES_PASSWORD"))
+                )
+    return _replica_pool
+
+
+def __getattr__(name):
+    # Keeps pool.connection_pool working without forcing the pool open at import
+    if name == 'connection_pool':
+        return get_pool()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if not LAZY:
+    get_pool()
 
 # Functions to handle connection pools
 
 # Grab a connection from pool
-def get_connection():
-    return connection_pool.getconn()
+def get_connection(timeout=None, started=None):
+    return get_pool().getconn(timeout, started)
 
 # Put connection back into pool
 def release_connection(conn):
-    connection_pool.putconn(conn)
\ No newline at end of file
+    get_pool().putconn(conn)
+
+# Borrow a connection for a with block
+def connection(timeout=None):
+    return get_pool().connection(timeout)
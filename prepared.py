@@ -0,0 +1,125 @@
+"""
+Prepared statement registry for the constants in queries.py.
+
+Each query constant is registered under its own name. The first time a pooled connection runs one, it is PREPAREd on
+that connection. After that the db helpers send EXECUTE name (...) instead of the full SQL, so Postgres skips
+parsing and planning on every request. A reconnected connection starts with nothing prepared, so statements are
+prepared again on it automatically.
+
+Routes keep passing the queries.py constants to the db helpers. The registry recognises the SQL text, so those
+constants are the statement names. Set PREPARED_STATEMENTS=0 when running behind a transaction-mode pooler such as
+PgBouncer, where a session's prepared statements don't follow it from one transaction to the next.
+"""
+import os
+import re
+import threading
+import weakref
+
+import metrics
+import queries as q
+
+ENABLED = os.getenv('PREPARED_STATEMENTS', '1') == '1'
+
+_PLACEHOLDER = re.compile(r"%(s|%)")
+
+
+class Statement:
+    """
+    One registered query.
+        name: server-side statement name
+        sql: the query with %s placeholders turned into $1, $2, ...
+        arity: number of parameters
+    """
+    __slots__ = ("name", "sql", "arity", "execute_sql")
+
+    def __init__(self, name, text):
+        count = 0
+
+        def number(match):
+            nonlocal count
+            if match.group(1) == "%":
+                return "%"
+            count += 1
+            return f"${count}"
+
+        self.name = name
+        self.sql = _PLACEHOLDER.sub(number, text.strip().rstrip(";"))
+        self.arity = count
+        args = ", ".join(["%s"] * count)
+        self.execute_sql = f"EXECUTE {name} ({args})" if count else f"EXECUTE {name}"
+
+
+def preparable(text):
+    """
+    Single SELECT/INSERT/UPDATE/DELETE statements. DDL, execute_values templates (a bare VALUES %s) and the
+    {columns} templates pagination.py fills in are left alone.
+    """
+    head = text.lstrip().split(None, 1)[0].upper() if text.strip() else ""
+    return head in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH") and "VALUES %s" not in text and "{columns}" not in text
+
+
+class Registry:
+    def __init__(self):
+        self._by_sql = {}
+        self._prepared = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.prepares = 0
+        self.executions = 0
+        self.failures = 0
+
+    def __len__(self):
+        return len(self._by_sql)
+
+    def register(self, name, text):
+        if preparable(text):
+            statement = Statement(f"q_{name.lower()}", text)
+            self._by_sql[text] = statement
+            metrics.QUERY_NAMES[statement.execute_sql] = name
+
+    def register_module(self, module):
+        for name, value in vars(module).items():
+            if name.isupper() and isinstance(value, str):
+                self.register(name, value)
+
+    def _prepare(self, connection, cursor, statement):
+        # Behind a savepoint so a statement Postgres refuses to prepare doesn't abort the caller's transaction
+        cursor.execute("SAVEPOINT prepare_statement")
+        try:
+            cursor.execute(f"PREPARE {statement.name} AS {statement.sql}")
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT prepare_statement")
+            self.failures += 1
+            return False
+        cursor.execute("RELEASE SAVEPOINT prepare_statement")
+        self.prepares += 1
+        return True
+
+    def execute(self, connection, cursor, query, params=None):
+        """
+        Runs query on cursor, through its prepared statement when it has one.
+        """
+        statement = self._by_sql.get(query) if ENABLED else None
+        if statement is None:
+            cursor.execute(query, params)
+            return
+
+        with self._lock:
+            prepared = self._prepared.setdefault(connection, set())
+        if statement.name not in prepared:
+            if not self._prepare(connection, cursor, statement):
+                # Never try this one again, run it as plain SQL from now on
+                self._by_sql.pop(query, None)
+                cursor.execute(query, params)
+                return
+            prepared.add(statement.name)
+
+        self.executions += 1
+        cursor.execute(statement.execute_sql, params)
+
+
+registry = Registry()
+registry.register_module(q)
+
+
+def execute(connection, cursor, query, params=None):
+    registry.execute(connection, cursor, query, params)
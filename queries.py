@@ -10,6 +10,7 @@ GET_ALL_USERS = "SELECT * from public.user"
 GET_USER_BY_ID = "SELECT * from public.user WHERE user_id = %s"
 GET_USER_BY_USERNAME = "SELECT * from public.user WHERE user_name = %s"
 CREATE_NEW_USER= "INSERT INTO public.user (user_id, user_name, password, isadmin) VALUES (%s, %s, %s, %s);"
+UPDATE_USER_PASSWORD = "UPDATE public.user SET password = %s WHERE user_id = %s"
 
 """
 Table based queries
@@ -19,6 +20,46 @@ CLEAR_RESERVATION = "UPDATE public.table SET table_available = True WHERE table_
 CLEAR_ALL_RESERVATIONS = "UPDATE public.table SET table_available = True;"
 SELECT_RESERVATION = "SELECT * FROM public.table WHERE table_id = %s;"
 GET_TABLE_INFO = "SELECT * FROM public.table ORDER BY table_id;"
+SELECT_RESERVATIONS = "SELECT * FROM public.table WHERE table_id = ANY(%s);"
+# Reserves the smallest free candidate that fits the party and records its expiry, in one statement.
+# SKIP LOCKED steps over a table another host is taking at the same moment instead of waiting on it.
+# Params: party size, candidate table ids (smallest first), expires_at
+ALLOCATE_TABLE = """WITH chosen AS (
+    SELECT table_id FROM public.table
+    WHERE table_available AND max_customer >= %s AND table_id = ANY(%s)
+    ORDER BY max_customer, table_id LIMIT 1 FOR UPDATE SKIP LOCKED
+), reserved AS (
+    UPDATE public.table t SET table_available = False FROM chosen WHERE t.table_id = chosen.table_id RETURNING t.table_id
+)
+INSERT INTO public.table_expiry (table_id, expires_at) SELECT table_id, %s FROM reserved
+ON CONFLICT (table_id) DO UPDATE SET expires_at = EXCLUDED.expires_at RETURNING table_id;"""
+
+# Pending reservation expiries, one row per reserved table, created by migrate.py. Read back on startup by the expiry
+# scheduler
+CREATE_TABLE_EXPIRY_TABLE = "CREATE TABLE IF NOT EXISTS public.table_expiry (table_id integer PRIMARY KEY, expires_at timestamptz NOT NULL);"
+SET_TABLE_EXPIRY = "INSERT INTO public.table_expiry (table_id, expires_at) VALUES (%s, %s) ON CONFLICT (table_id) DO UPDATE SET expires_at = EXCLUDED.expires_at;"
+CLEAR_TABLE_EXPIRY = "DELETE FROM public.table_expiry WHERE table_id = %s;"
+CLEAR_ALL_TABLE_EXPIRIES = "DELETE FROM public.table_expiry;"
+GET_TABLE_EXPIRIES = "SELECT table_id, expires_at FROM public.table_expiry;"
+# Only removes the row if it still holds the deadline that fired, so a reservation renewed in the meantime survives.
+# Compared with the scheduler's deadline rather than now(), so a database clock running behind can't skip the reset
+TAKE_DUE_TABLE_EXPIRY = "DELETE FROM public.table_expiry WHERE table_id = %s AND expires_at <= %s RETURNING table_id;"
+
+"""
+Booking based queries. The exclusion constraint is what guarantees a table is never booked twice for the same time
+"""
+CREATE_BOOKING_EXTENSION = "CREATE EXTENSION IF NOT EXISTS btree_gist;"
+CREATE_BOOKING_TABLE = """CREATE TABLE IF NOT EXISTS public.booking (
+    booking_id serial PRIMARY KEY,
+    table_id integer NOT NULL,
+    customer_id integer,
+    party_size integer NOT NULL,
+    during tstzrange NOT NULL,
+    EXCLUDE USING gist (table_id WITH =, during WITH &&)
+);"""
+CREATE_BOOKING = "INSERT INTO public.booking (table_id, customer_id, party_size, during) VALUES (%s, %s, %s, tstzrange(%s, %s)) RETURNING booking_id;"
+CANCEL_BOOKING = "DELETE FROM public.booking WHERE booking_id = %s RETURNING booking_id;"
+GET_UPCOMING_BOOKINGS = "SELECT booking_id, table_id, lower(during), upper(during) FROM public.booking WHERE upper(during) > now();"
 
 """ Customer Based Queries"""
 GET_ALL_CUSTOMERS = "SELECT * FROM public.customer ORDER BY customer_id;"
@@ -31,10 +72,159 @@ GET_ORDER_BY_ID = "SELECT * FROM public.order WHERE order_id = %s;"
 GET_ORDER_ITEMS_BY_ID = "SELECT * FROM public.order_items WHERE order_id = %s;"
 GET_CUSTOMER_ID_BY_EMAIL = "SELECT customer_id from public.customer where customer_email=%s"
 
+# Batched forms of the per-id lookups, used by the loaders in app.py. Each takes a list of ids
+GET_CUSTOMERS_BY_IDS = "SELECT * FROM public.customer WHERE customer_id = ANY(%s);"
+GET_CUSTOMER_IDS_BY_EMAILS = "SELECT customer_id, customer_email from public.customer where customer_email = ANY(%s);"
+GET_ORDERS_BY_IDS = "SELECT * FROM public.order WHERE order_id = ANY(%s);"
+GET_ORDER_ITEMS_BY_IDS = "SELECT * FROM public.order_items WHERE order_id = ANY(%s);"
+
+# Schema setup, see migrate.py. The lock is held for the whole run, so two deploys can't migrate at the same time, and
+# is released when its connection closes
+LOCK_MIGRATIONS = "SELECT pg_advisory_lock(hashtext('schema_changes'));"
+GET_INDEX_VALID = "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);"
+DROP_INDEX = "DROP INDEX CONCURRENTLY IF EXISTS {};"
+GET_MISSING_RELATIONS = "SELECT name FROM unnest(%s::text[]) AS name WHERE to_regclass(name) IS NULL;"
+
+# Customer search, see search.py. The trigram indexes, built by migrate.py, serve both the LIKE prefix matches and the
+# fuzzy <% matches.
+# Search params: term, term, name prefix, email prefix, phone prefix (repeated for the score and the filter), term,
+# term, limit. A prefix of NULL matches nothing
+CREATE_SEARCH_EXTENSION = "CREATE EXTENSION IF NOT EXISTS pg_trgm;"
+CREATE_CUSTOMER_NAME_INDEX = "CREATE INDEX CONCURRENTLY IF NOT EXISTS customer_name_trgm ON public.customer USING gin (lower(customer_name) gin_trgm_ops);"
+CREATE_CUSTOMER_EMAIL_INDEX = "CREATE INDEX CONCURRENTLY IF NOT EXISTS customer_email_trgm ON public.customer USING gin (lower(customer_email) gin_trgm_ops);"
+CREATE_CUSTOMER_PHONE_INDEX = "CREATE INDEX CONCURRENTLY IF NOT EXISTS customer_phone_trgm ON public.customer USING gin (regexp_replace(customer_phone, '[^0-9]', '', 'g') gin_trgm_ops);"
+SEARCH_CUSTOMERS = """SELECT customer_id, customer_name, customer_address, customer_phone, customer_email,
+    greatest(word_similarity(%s, lower(customer_name)), word_similarity(%s, lower(customer_email)),
+             CASE WHEN lower(customer_name) LIKE %s OR lower(customer_email) LIKE %s
+                       OR regexp_replace(customer_phone, '[^0-9]', '', 'g') LIKE %s THEN 1 ELSE 0 END) AS score
+    FROM public.customer
+    WHERE lower(customer_name) LIKE %s OR lower(customer_email) LIKE %s OR regexp_replace(customer_phone, '[^0-9]', '', 'g') LIKE %s
+        OR %s <%% lower(customer_name) OR %s <%% lower(customer_email)
+    ORDER BY score DESC, customer_id
+    LIMIT %s;"""
+# The regulars, kept in search.py's in-memory prefix index
+GET_FREQUENT_CUSTOMERS = """SELECT customer_id, customer_name, customer_address, customer_phone, customer_email FROM public.customer
+    WHERE customer_id IN (SELECT customer_id FROM public.order WHERE customer_id IS NOT NULL
+                          GROUP BY customer_id ORDER BY count(*) DESC LIMIT %s);"""
+
+# Stored responses for Idempotency-Key retries. A key whose row has outlived the TTL can be claimed again.
+# Claim params: scope, key, request hash, ttl seconds
+CREATE_IDEMPOTENCY_TABLE = """CREATE TABLE IF NOT EXISTS public.idempotency_key (
+    scope text NOT NULL,
+    key text NOT NULL,
+    request_hash text NOT NULL,
+    response jsonb,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (scope, key)
+);"""
+CLAIM_IDEMPOTENCY_KEY = """INSERT INTO public.idempotency_key (scope, key, request_hash) VALUES (%s, %s, %s)
+ON CONFLICT (scope, key) DO UPDATE SET request_hash = EXCLUDED.request_hash, response = NULL, created_at = now()
+WHERE idempotency_key.created_at < now() - make_interval(secs => %s) RETURNING key;"""
+GET_IDEMPOTENT_RESPONSE = "SELECT request_hash, response FROM public.idempotency_key WHERE scope = %s AND key = %s;"
+SAVE_IDEMPOTENT_RESPONSE = "UPDATE public.idempotency_key SET response = %s WHERE scope = %s AND key = %s;"
+PURGE_IDEMPOTENCY_KEYS = "DELETE FROM public.idempotency_key WHERE created_at < now() - make_interval(secs => %s);"
+
+# Cross-worker change events, see coordination.py. pg_notify inside a transaction is only delivered on commit
+NOTIFY_EVENT = "SELECT pg_notify(%s, %s);"
+LISTEN_EVENTS = "LISTEN {};"
+
+# Keyset pages for the list routes. pagination.py fills in {columns}, {table} and {key} from fixed whitelists.
+# LIMIT NULL reads to the end
+LIST_FIRST_PAGE = "SELECT {columns} FROM {table} ORDER BY {key} LIMIT %s;"
+LIST_NEXT_PAGE = "SELECT {columns} FROM {table} WHERE {key} > %s ORDER BY {key} LIMIT %s;"
+
+# Every order with its items aggregated alongside, so exports can stream orders without a second pass
+EXPORT_ALL_ORDERS = """SELECT o.*, COALESCE(json_agg(json_build_object('food_id', i.food_id, 'quantity', i.quantity)) FILTER (WHERE i.order_id IS NOT NULL), '[]') AS items
+FROM public.order o LEFT JOIN public.order_items i ON i.order_id = o.order_id
+GROUP BY o.order_id ORDER BY o.order_id;"""
+
 # The order_date, order_status, employee_id, and guest_amount are currently ignored.
 CREATE_ORDER = "INSERT INTO public.order (customer_id, table_id) VALUES (%s, %s) RETURNING order_id;"
 CREATE_ORDER_ITEM = "INSERT INTO public.order_items (food_id, order_id, quantity) VALUES (%s, %s, %s)"
+# Multi-row forms for psycopg2.extras.execute_values, which expands the single %s into a VALUES list
+CREATE_ORDER_ITEMS = "INSERT INTO public.order_items (food_id, order_id, quantity) VALUES %s"
+CREATE_ORDERS_WITH_ID = "INSERT INTO public.order (order_id, customer_id, table_id) VALUES %s"
+# Draws ids for a batch of orders up front, so the batch insert doesn't rely on the order RETURNING rows come back in
+RESERVE_ORDER_IDS = "SELECT nextval(pg_get_serial_sequence('public.order', 'order_id')) FROM generate_series(1, %s);"
+
+# Returns the table the order was cleared from, and nothing if it had already been cleared
+CLEAR_ORDER = """UPDATE public.order o SET table_id = NULL FROM public.order old
+    WHERE o.order_id = %s AND old.order_id = o.order_id AND o.table_id IS NOT NULL RETURNING old.table_id;"""
 
-CLEAR_ORDER = "UPDATE public.order SET table_id = NULL WHERE order_id = %s;"
+CLEAR_ALL_ORDERS = "UPDATE public.order SET table_id = NULL;"
+
+"""
+Analytics rollups, see analytics.py. Created and first filled by migrate.py, then kept up to date in the same transaction as the order writes. Food and hourly
+buckets are split into shards by order_id, so concurrent orders for the same dish or hour don't queue on one row
+"""
+CREATE_TABLE_ROLLUP = """CREATE TABLE IF NOT EXISTS public.table_rollup (
+    table_id integer PRIMARY KEY,
+    orders bigint NOT NULL DEFAULT 0,
+    open_orders bigint NOT NULL DEFAULT 0,
+    items bigint NOT NULL DEFAULT 0
+);"""
+CREATE_FOOD_ROLLUP = """CREATE TABLE IF NOT EXISTS public.food_rollup (
+    food_id integer NOT NULL,
+    shard smallint NOT NULL,
+    quantity bigint NOT NULL DEFAULT 0,
+    orders bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (food_id, shard)
+);"""
+CREATE_HOURLY_ROLLUP = """CREATE TABLE IF NOT EXISTS public.hourly_rollup (
+    hour timestamptz NOT NULL,
+    shard smallint NOT NULL,
+    orders bigint NOT NULL DEFAULT 0,
+    items bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, shard)
+);"""
+ROLLUPS_EMPTY = "SELECT NOT EXISTS (SELECT 1 FROM public.hourly_rollup) AND NOT EXISTS (SELECT 1 FROM public.table_rollup) AS empty;"
+# Adds a list of just placed orders to every rollup. Params: shard count, order ids. Rows are upserted in key order,
+# so two transactions touching the same buckets lock them in the same order and can't deadlock
+ADD_ORDERS_TO_ROLLUPS = """WITH placed AS (
+    SELECT o.order_id, o.table_id, o.order_id %% %s AS shard,
+        (SELECT COALESCE(sum(i.quantity), 0) FROM public.order_items i WHERE i.order_id = o.order_id) AS items
+    FROM public.order o WHERE o.order_id = ANY(%s)
+), tables AS (
+    INSERT INTO public.table_rollup AS r (table_id, orders, open_orders, items)
+    SELECT table_id, count(*), count(*), sum(items) FROM placed WHERE table_id IS NOT NULL GROUP BY table_id ORDER BY table_id
+    ON CONFLICT (table_id) DO UPDATE SET orders = r.orders + EXCLUDED.orders,
+        open_orders = r.open_orders + EXCLUDED.open_orders, items = r.items + EXCLUDED.items
+), foods AS (
+    INSERT INTO public.food_rollup AS r (food_id, shard, quantity, orders)
+    SELECT i.food_id, p.shard, sum(i.quantity), count(DISTINCT i.order_id)
+    FROM public.order_items i JOIN placed p ON p.order_id = i.order_id
+    GROUP BY i.food_id, p.shard ORDER BY i.food_id, p.shard
+    ON CONFLICT (food_id, shard) DO UPDATE SET quantity = r.quantity + EXCLUDED.quantity, orders = r.orders + EXCLUDED.orders
+)
+INSERT INTO public.hourly_rollup AS r (hour, shard, orders, items)
+SELECT date_trunc('hour', now()), shard, count(*), sum(items) FROM placed GROUP BY shard ORDER BY shard
+ON CONFLICT (hour, shard) DO UPDATE SET orders = r.orders + EXCLUDED.orders, items = r.items + EXCLUDED.items;"""
+# Counts what is already in public.order, for databases that had orders before the rollups existed. Cleared orders
+# have lost their table, so only open orders are counted per table, and orders without an order_date go in the
+# hour of the backfill. Params: shard count
+BACKFILL_ROLLUPS = """WITH placed AS (
+    SELECT o.order_id, o.table_id, o.order_id %% %s AS shard,
+        date_trunc('hour', COALESCE(o.order_date::timestamptz, now())) AS hour,
+        (SELECT COALESCE(sum(i.quantity), 0) FROM public.order_items i WHERE i.order_id = o.order_id) AS items
+    FROM public.order o
+), tables AS (
+    INSERT INTO public.table_rollup (table_id, orders, open_orders, items)
+    SELECT table_id, count(*), count(*), sum(items) FROM placed WHERE table_id IS NOT NULL GROUP BY table_id
+), foods AS (
+    INSERT INTO public.food_rollup (food_id, shard, quantity, orders)
+    SELECT i.food_id, p.shard, sum(i.quantity), count(DISTINCT i.order_id)
+    FROM public.order_items i JOIN placed p ON p.order_id = i.order_id GROUP BY i.food_id, p.shard
+)
+INSERT INTO public.hourly_rollup (hour, shard, orders, items)
+SELECT hour, shard, count(*), sum(items) FROM placed GROUP BY hour, shard;"""
+CLOSE_TABLE_ROLLUP = "UPDATE public.table_rollup SET open_orders = open_orders - 1 WHERE table_id = %s AND open_orders > 0;"
+CLOSE_ALL_TABLE_ROLLUPS = "UPDATE public.table_rollup SET open_orders = 0 WHERE open_orders <> 0;"
+GET_TABLE_ROLLUP = "SELECT table_id, orders, open_orders, items FROM public.table_rollup ORDER BY table_id;"
+GET_FOOD_ROLLUP = """SELECT food_id, sum(quantity)::bigint AS quantity, sum(orders)::bigint AS orders FROM public.food_rollup
+    GROUP BY food_id ORDER BY sum(quantity) DESC, food_id LIMIT %s;"""
+GET_HOURLY_ROLLUP = """SELECT hour, sum(orders)::bigint AS orders, sum(items)::bigint AS items FROM public.hourly_rollup
+    WHERE hour >= %s AND hour < %s GROUP BY hour ORDER BY hour;"""
 
-CLEAR_ALL_ORDERS = "UPDATE public.order SET table_id = NULL;"
\ No newline at end of file
+# Run on the read replica. Seconds behind the primary, zero once everything received has been replayed
+REPLICA_LAG = """SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END;"""
\ No newline at end of file
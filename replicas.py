@@ -0,0 +1,98 @@
+"""
+Read-replica routing. When POSTGRES_REPLICA_HOST is set, read-only queries can go to a replica instead of competing
+with reservations on the primary.
+
+A read is sent to the replica only when:
+    the last lag check succeeded and the lag is within POSTGRES_REPLICA_MAX_LAG seconds
+    the client making the request hasn't written recently (read-your-writes). After a write, that client's reads
+    stay on the primary for POSTGRES_REPLICA_STICKY seconds, or twice the measured lag if that is longer
+Otherwise the read falls back to the primary.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import time
+
+MAX_LAG = float(os.getenv('POSTGRES_REPLICA_MAX_LAG', 5))
+STICKY_SECONDS = float(os.getenv('POSTGRES_REPLICA_STICKY', 10))
+CHECK_INTERVAL = float(os.getenv('POSTGRES_REPLICA_CHECK_INTERVAL', 2))
+
+log = logging.getLogger(__name__)
+
+# Who the current request is for. Set per request by the middleware in app.py
+current_client = contextvars.ContextVar('current_client', default=None)
+
+
+class ReplicaRouter:
+    """
+    Decides per read whether the replica can serve it.
+        enabled: False when no replica is configured
+    """
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.healthy = False
+        self.lag = None
+        self._writers = {}
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    def note_write(self, client=None):
+        """
+        Keeps client's reads on the primary until the replica has had time to catch up with this write.
+        """
+        client = current_client.get() if client is None else client
+        if not self.enabled or client is None:
+            return
+        now = time.monotonic()
+        self._writers[client] = now + max(STICKY_SECONDS, 2 * (self.lag or 0))
+        # Forget clients whose window has passed, now and then, so the map stays small
+        if len(self._writers) > 1024:
+            self._writers = {key: until for key, until in self._writers.items() if until > now}
+
+    def _recent_writer(self, client):
+        until = self._writers.get(client)
+        if until is None:
+            return False
+        if until <= time.monotonic():
+            del self._writers[client]
+            return False
+        return True
+
+    def use_replica(self):
+        usable = (self.enabled and self.healthy and self.lag is not None and self.lag <= MAX_LAG
+                  and not self._recent_writer(current_client.get()))
+        if usable:
+            self.replica_reads += 1
+        else:
+            self.primary_reads += 1
+        return usable
+
+    def failed(self):
+        # Stay on the primary until the next successful lag check
+        self.healthy = False
+
+    def observe_lag(self, lag):
+        self.lag = lag
+        self.healthy = True
+
+    async def monitor(self, check_lag):
+        """
+        Polls the replica's lag forever. check_lag is a coroutine returning the lag in seconds.
+        """
+        while True:
+            try:
+                self.observe_lag(await check_lag())
+            except Exception as e:
+                log.warning("Replica lag check failed: %s", e)
+                self.failed()
+            await asyncio.sleep(CHECK_INTERVAL)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'healthy': self.healthy,
+            'lag': self.lag,
+            'replica_reads': self.replica_reads,
+            'primary_reads': self.primary_reads,
+        }
@@ -0,0 +1,37 @@
+"""
+Fast JSON responses for the list routes.
+
+A route that returns a list of dicts has it walked by FastAPI's jsonable_encoder and then encoded by the standard
+json module. The list routes already build plain dicts, so they return FastJSONResponse directly and skip the
+encoder walk. Encoding goes through orjson when it is installed, several times faster on large lists, and falls back
+to the json module otherwise with the same output.
+"""
+import datetime
+import decimal
+import json
+import uuid
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    # The types jsonable_encoder would have converted for us
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        if orjson is not None:
+            return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
@@ -0,0 +1,18 @@
+"""
+Row types for query results.
+
+Pooled connections hand back every row as a namedtuple built from the cursor description, so routes read
+row.order_id rather than row[6]. The names come from the database, so adding or reordering columns in a table can't
+shift a value into the wrong response field. Rows still index by position, for single-column results like
+RETURNING order_id.
+"""
+from psycopg2.extras import NamedTupleCursor
+
+from metrics import TimedCursor
+
+
+class Cursor(TimedCursor, NamedTupleCursor):
+    """
+    cursor_factory for the pool: namedtuple rows, with every statement timed by metrics.TimedCursor. psycopg2 caches
+    the namedtuple class per description, so building rows costs about the same as plain tuples.
+    """
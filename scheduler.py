@@ -0,0 +1,111 @@
+"""
+Reservation expiry scheduler. Replaces the one sleeping task per reservation with a single background task that
+sleeps until the earliest deadline in a heap.
+
+Cancelling only marks the heap entry dead, so clear_table and clear_all_tables never search the heap. Deadlines are
+persisted in public.table_expiry by the routes, and start() reloads them so a restart doesn't forget reservations.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Heap entry layout. Entries are lists so they can be flagged dead in place. DEADLINE is the datetime as given
+WHEN, SEQ, KEY, ACTIVE, DEADLINE = range(5)
+
+
+class ExpiryScheduler:
+    """
+    Calls on_expire(key, deadline) once for every key whose deadline passes without being cancelled.
+        on_expire: coroutine function taking the key (a table number) and the deadline it was scheduled with
+    """
+    def __init__(self, on_expire):
+        self.on_expire = on_expire
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def schedule(self, key, when):
+        """
+        Sets (or moves) the deadline for key. when is a timezone aware datetime.
+        """
+        self.cancel(key)
+        entry = [when.timestamp(), next(self._counter), key, True, when]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        # Only a new earliest deadline changes how long the loop should sleep
+        if self._heap[0] is entry:
+            self._wakeup.set()
+        # Dead entries are normally dropped as they reach the top; rebuild if they pile up
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [e for e in self._heap if e[ACTIVE]]
+            heapq.heapify(self._heap)
+
+    def cancel(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry[ACTIVE] = False
+
+    def cancel_all(self):
+        self._heap = []
+        self._entries = {}
+        self._wakeup.set()
+
+    def start(self, pending=()):
+        """
+        Starts the background task. pending is an iterable of (key, when) pairs reloaded from the database.
+        Deadlines that passed while the app was down fire straight away.
+        """
+        for key, when in pending:
+            self.schedule(key, when)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            while self._heap and (not self._heap[0][ACTIVE] or self._heap[0][WHEN] <= now):
+                entry = heapq.heappop(self._heap)
+                if entry[ACTIVE]:
+                    del self._entries[entry[KEY]]
+                    self._fire(entry[KEY], entry[DEADLINE])
+
+            timeout = self._heap[0][WHEN] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, key, deadline):
+        # Hold a reference until the callback finishes so the task isn't garbage collected mid-flight
+        task = asyncio.create_task(self._call(key, deadline))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _call(self, key, deadline):
+        try:
+            await self.on_expire(key, deadline)
+        except Exception as e:
+            log.exception("Expiry for %s failed: %s", key, e)
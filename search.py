@@ -0,0 +1,158 @@
+"""
+Customer search by name, phone or email, for the host stand looking up a regular.
+
+Two tiers:
+    an in-memory prefix index over the SEARCH_HOT_SET customers with the most orders, which answers a typed prefix
+    without a query when it finds enough of them
+    SEARCH_CUSTOMERS in Postgres, over every customer: prefix matches plus typo tolerant pg_trgm word similarity,
+    both served by the trigram indexes migrate.py builds
+
+Prefix matches rank first, then the rest by similarity. The hot set is reloaded in the background every
+SEARCH_REFRESH seconds, so customers added since then are found through Postgres until the next reload.
+"""
+import asyncio
+import bisect
+import logging
+import os
+import re
+import time
+
+import queries as q
+
+HOT_SET = int(os.getenv('SEARCH_HOT_SET', 5000))
+REFRESH = float(os.getenv('SEARCH_REFRESH', 300))
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+MIN_LENGTH = 2
+# Fewer digits than this are too common in phone numbers to be worth matching on
+MIN_PHONE_DIGITS = 3
+
+log = logging.getLogger(__name__)
+
+_WORD = re.compile(r"[^\W_]+")
+
+
+def _digits(text):
+    return re.sub(r"\D", "", text or "")
+
+
+def _like_prefix(text):
+    return re.sub(r"([\\%_])", r"\\\1", text) + "%"
+
+
+def tokens(row):
+    """
+    What a customer can be found by: each word of the name, the email and its local part, and the phone's digits.
+    """
+    found = set(_WORD.findall((row.customer_name or "").lower()))
+    email = (row.customer_email or "").lower()
+    if email:
+        found.add(email)
+        found.add(email.split("@", 1)[0])
+    phone = _digits(row.customer_phone)
+    if phone:
+        found.add(phone)
+    return found
+
+
+class PrefixIndex:
+    """
+    Sorted (token, customer_id) pairs, so all the tokens starting with a prefix are one bisect away.
+    """
+    def __init__(self):
+        self._entries = []
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def load(self, rows):
+        self._rows = {row.customer_id: row for row in rows}
+        self._entries = sorted({(token, row.customer_id) for row in rows for token in tokens(row)})
+
+    def _starting_with(self, prefix):
+        found = set()
+        for token, customer_id in self._entries[bisect.bisect_left(self._entries, (prefix, )):]:
+            if not token.startswith(prefix):
+                break
+            found.add(customer_id)
+        return found
+
+    def search(self, term, limit):
+        """
+        Customers with a token starting with every word of term (or with term's digits), in customer_id order.
+        """
+        words = _WORD.findall(term.lower())
+        matches = None
+        for word in words:
+            found = self._starting_with(word)
+            matches = found if matches is None else matches & found
+            if not matches:
+                break
+        digits = _digits(term)
+        if len(digits) >= MIN_PHONE_DIGITS and digits not in words:
+            matches = (matches or set()) | self._starting_with(digits)
+        return [self._rows[customer_id] for customer_id in sorted(matches or ())[:limit]]
+
+
+class CustomerSearch:
+    """
+        fetchall: coroutine function taking (query, params), used for both tiers
+    """
+    def __init__(self, fetchall, hot_set=HOT_SET, refresh=REFRESH):
+        self.fetchall = fetchall
+        self.hot_set = hot_set
+        self.refresh = refresh
+        self.index = PrefixIndex()
+        self._loaded_at = None
+        self._loading = None
+        self.index_answers = 0
+        self.queries = 0
+
+    def _refresh_if_stale(self):
+        # The first search still goes to Postgres, it doesn't wait for the index
+        stale = self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh
+        if stale and self._loading is None and self.hot_set > 0:
+            self._loading = asyncio.create_task(self._load())
+
+    async def _load(self):
+        try:
+            self.index.load(await self.fetchall(q.GET_FREQUENT_CUSTOMERS, (self.hot_set, )))
+        except Exception as e:
+            log.warning("Could not load the customer search index: %s", e)
+        finally:
+            # A failed load is retried after the same interval, not on every search
+            self._loaded_at = time.monotonic()
+            self._loading = None
+
+    def params(self, term, limit):
+        lowered = term.lower()
+        prefix = _like_prefix(lowered)
+        digits = _digits(term)
+        phone = _like_prefix(digits) if len(digits) >= MIN_PHONE_DIGITS else None
+        return (lowered, lowered, prefix, prefix, phone, prefix, prefix, phone, lowered, lowered, limit)
+
+    async def search(self, term, limit=DEFAULT_LIMIT):
+        """
+        Returns:
+            [(row, score)], best first. Prefix matches score 1
+        """
+        self._refresh_if_stale()
+        hot = self.index.search(term, limit)
+        if len(hot) >= limit:
+            self.index_answers += 1
+            return [(row, 1.0) for row in hot]
+
+        self.queries += 1
+        results = [(row, 1.0) for row in hot]
+        seen = {row.customer_id for row in hot}
+        for row in await self.fetchall(q.SEARCH_CUSTOMERS, self.params(term, limit)):
+            if row.customer_id not in seen and len(results) < limit:
+                seen.add(row.customer_id)
+                results.append((row, float(row.score)))
+        # Regulars first among equals, then by how well they match
+        results.sort(key=lambda result: -result[1])
+        return results
+
+    def stats(self):
+        return {'hot_set': len(self.index), 'index_answers': self.index_answers, 'queries': self.queries}
@@ -0,0 +1,92 @@
+"""
+Cold start timing, for serverless deployments where every cold start is paid for by a waiting user.
+
+Import this first in app.py, right after .env is loaded so STARTUP_TIMING can come from it. It records how long the
+app took to import and how long until the first response went out. With STARTUP_TIMING=1 it also times every module
+import, the same numbers python -X importtime gives, so the slow imports can be found on the platform itself. The report is served at GET /startup.
+"""
+import os
+import sys
+import time
+
+STARTED = time.perf_counter()
+ENABLED = os.getenv('STARTUP_TIMING', '0') == '1'
+
+# Module name -> seconds spent executing it, nested imports included
+import_times = {}
+ready_at = None
+first_response_at = None
+
+
+class _TimingLoader:
+    """
+    Wraps a module loader to time exec_module. Everything else is passed through to the real loader.
+    """
+    def __init__(self, loader):
+        self._loader = loader
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            import_times[module.__name__] = time.perf_counter() - start
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+
+class _TimingFinder:
+    """
+    Meta path finder that defers to the real finders and wraps the loader they return.
+    """
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimingLoader(spec.loader)
+                return spec
+        return None
+
+
+if ENABLED:
+    sys.meta_path.insert(0, _TimingFinder())
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def mark_ready():
+    """
+    Call once the app module has finished importing.
+    """
+    global ready_at
+    if ready_at is None:
+        ready_at = time.perf_counter()
+
+
+def mark_response():
+    """
+    Call after each response. Only the first one is recorded. Returns True the first time.
+    """
+    global first_response_at
+    if first_response_at is not None:
+        return False
+    first_response_at = time.perf_counter()
+    return True
+
+
+def report(top=15):
+    slowest = sorted(import_times.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {
+        'import_ms': _ms(ready_at - STARTED if ready_at else None),
+        'first_response_ms': _ms(first_response_at - STARTED if first_response_at else None),
+        'module_import_ms': {name: _ms(seconds) for name, seconds in slowest} if ENABLED else None,
+    }
@@ -0,0 +1,94 @@
+import asyncio
+from types import SimpleNamespace
+
+from cache import TableCache
+from loader import Loader, group_rows
+
+
+class FakeTables:
+    """
+    public.table in memory. Each lookup reads the rows when it is sent and answers once release is set, like a
+    query that was already on the wire when a write committed.
+    """
+    def __init__(self):
+        self.rows = {1: SimpleNamespace(table_id=1, order_id=None)}
+        self.sent = asyncio.Event()
+        self.release = asyncio.Event()
+        self.queries = 0
+
+    async def fetch_all(self):
+        return list(self.rows.values())
+
+    async def fetch_batch(self, table_ids):
+        self.queries += 1
+        snapshot = [self.rows[table_id] for table_id in table_ids if table_id in self.rows]
+        self.sent.set()
+        await self.release.wait()
+        return group_rows(snapshot, 'table_id')
+
+
+def make_cache(tables):
+    loader = Loader(tables.fetch_batch, default=[], window=0)
+    return TableCache(tables.fetch_all, loader.load, key=lambda row: row.table_id, forget=loader.clear), loader
+
+
+def test_read_after_write_does_not_cache_the_earlier_query():
+    async def scenario():
+        tables = FakeTables()
+        table_cache, loader = make_cache(tables)
+
+        before = asyncio.create_task(table_cache.one(1))
+        await tables.sent.wait()
+
+        # A write commits while the first read's query is still in flight
+        tables.rows[1] = SimpleNamespace(table_id=1, order_id=7)
+        table_cache.invalidate(1)
+        after = asyncio.create_task(table_cache.one(1))
+        await asyncio.sleep(0)
+        tables.release.set()
+
+        old_rows, old_etag = await before
+        new_rows, new_etag = await after
+        cached_rows, cached_etag = await table_cache.one(1)
+        return tables, old_rows, old_etag, new_rows, new_etag, cached_rows, cached_etag
+
+    tables, old_rows, old_etag, new_rows, new_etag, cached_rows, cached_etag = asyncio.run(scenario())
+    assert old_rows[0].order_id is None and old_etag is None
+    assert new_rows[0].order_id == 7
+    assert cached_rows[0].order_id == 7 and cached_etag == new_etag
+    assert tables.queries == 2
+
+
+def test_concurrent_reads_share_one_query():
+    async def scenario():
+        tables = FakeTables()
+        tables.release.set()
+        table_cache, _ = make_cache(tables)
+        results = await asyncio.gather(*(table_cache.one(1) for _ in range(5)))
+        return tables, results
+
+    tables, results = asyncio.run(scenario())
+    assert tables.queries == 1
+    assert all(rows[0].order_id is None for rows, _ in results)
+
+
+def test_cancelled_batch_does_not_leave_loads_hanging():
+    async def scenario():
+        tables = FakeTables()
+        loader = Loader(tables.fetch_batch, default=[], window=0)
+        first = asyncio.create_task(loader.load(1))
+        await tables.sent.wait()
+        for task in list(loader._running):
+            task.cancel()
+        try:
+            await first
+        except asyncio.CancelledError:
+            pass
+        # The key is free again, so the next load sends a fresh query rather than waiting forever
+        tables.release.set()
+        rows = await asyncio.wait_for(loader.load(1), 1)
+        return loader, rows
+
+    loader, rows = asyncio.run(scenario())
+    assert rows[0].table_id == 1
+    assert not loader._inflight